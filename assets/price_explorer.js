@@ -0,0 +1,125 @@
+// Clientside callbacks of viz_app.py --clientside. The server sends the rows
+// of one type once, made by figures.performance_slice, and the indicator graph
+// is filtered and drawn here with the same traces as
+// figures.performance_figure
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    price_explorer: {
+        // Columns of the type to ask the server for, no update while the
+        // loaded rows already hold every column of the graph
+        request: function (typ, x, ys, data) {
+            var columns = [x].concat(ys || []).filter(function (col) {
+                return col;
+            });
+            if (data && data.type === typ) {
+                var missing = columns.filter(function (col) {
+                    return !(col in data.columns);
+                });
+                if (!missing.length) {
+                    return window.dash_clientside.no_update;
+                }
+                columns = Object.keys(data.columns).concat(missing);
+            }
+            return { type: typ, columns: columns };
+        },
+
+        figure: function (data, filt, filt3, x, ys) {
+            if (!data || !(x in data.columns)) {
+                return window.dash_clientside.no_update;
+            }
+            ys = (ys || []).filter(function (col) {
+                return col in data.columns;
+            });
+            var wanted = {};
+            (filt || []).forEach(function (name) {
+                wanted[name] = true;
+            });
+            var beds = {};
+            (filt3 || []).forEach(function (bed) {
+                beds[Number(bed)] = true;
+            });
+            // Rows come in runs of one suburb and bedrooms. Like plotly
+            // express the traces are ordered by bedrooms and then suburb in
+            // order of appearance
+            var runs = data.runs;
+            var bedRank = {};
+            var bedCount = 0;
+            var suburbRank = {};
+            var suburbCount = 0;
+            var groups = {};
+            var keys = [];
+            var start = 0;
+            for (var i = 0; i < runs.length.length; i++) {
+                var suburb = data.suburbs[runs.suburb[i]];
+                var bed = runs.bedrooms[i];
+                var end = start + runs.length[i];
+                if (wanted[suburb] && beds[bed]) {
+                    if (!(bed in bedRank)) {
+                        bedRank[bed] = bedCount++;
+                    }
+                    if (!(suburb in suburbRank)) {
+                        suburbRank[suburb] = suburbCount++;
+                    }
+                    var key = bed + ", " + suburb;
+                    if (!(key in groups)) {
+                        groups[key] = { bed: bed, suburb: suburb, rows: [] };
+                        keys.push(key);
+                    }
+                    for (var row = start; row < end; row++) {
+                        groups[key].rows.push(row);
+                    }
+                }
+                start = end;
+            }
+            keys.sort(function (a, b) {
+                var ga = groups[a];
+                var gb = groups[b];
+                return (
+                    bedRank[ga.bed] - bedRank[gb.bed] ||
+                    suburbRank[ga.suburb] - suburbRank[gb.suburb]
+                );
+            });
+
+            function axis(col, rows) {
+                var values = data.columns[col];
+                return rows.map(function (row) {
+                    var value = values[row];
+                    if (col !== "DATE" || value === null) {
+                        return value;
+                    }
+                    var month = (value % 12) + 1;
+                    return (
+                        Math.floor(value / 12) + "-" + (month < 10 ? "0" : "") + month + "-01"
+                    );
+                });
+            }
+
+            var traces = [];
+            ys.forEach(function (y, variable) {
+                keys.forEach(function (key) {
+                    var group = groups[key];
+                    var color = data.colors[bedRank[group.bed] % data.colors.length];
+                    var dash = data.dashes[suburbRank[group.suburb] % data.dashes.length];
+                    traces.push({
+                        type: "scatter",
+                        mode: variable === 0 ? "lines" : "lines+markers",
+                        name: key,
+                        legendgroup: key,
+                        showlegend: variable === 0,
+                        x: axis(x, group.rows),
+                        y: axis(y, group.rows),
+                        line: { color: color, dash: dash },
+                        marker: { color: color },
+                        hovertemplate:
+                            "Beds=" + group.bed + "<br>Suburb=" + group.suburb + "<br>" +
+                            x + "=%{x}<br>" + y + "=%{y}<extra></extra>",
+                    });
+                });
+            });
+            var layout = JSON.parse(JSON.stringify(data.layout));
+            layout.xaxis.title.text = x;
+            layout.yaxis.title.text = ys.length ? ys[0] : "";
+            layout.uirevision = x;
+            return { data: traces, layout: layout };
+        },
+    },
+});
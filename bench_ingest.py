@@ -0,0 +1,160 @@
+# End to end ingest benchmark against mock_domain_api.py, no real quota is
+# used. Runs house_prices.py for a whole synthetic city and reports combos/s
+# and rows/s, e.g.
+#
+#   python3 bench_ingest.py --suburbs 650 --latency 0.05 --workers 1 4 8
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_domain_api import MockConfig, start_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def seed_suburbs(database, city, n):
+    conn = sqlite3.connect(database)
+    conn.execute("DROP TABLE IF EXISTS suburbs_{}".format(city))
+    conn.execute(
+        "CREATE TABLE suburbs_{} (suburb_name TEXT, postcode INTEGER NOT NULL)".format(
+            city
+        )
+    )
+    conn.executemany(
+        "INSERT INTO suburbs_{} VALUES (?,?)".format(city),
+        [("Suburb {}".format(i), 2000 + i) for i in range(n)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def count(database, query):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute(query).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def run_ingest(database, city, url, workers, args, extra):
+    # Cache and metrics files go next to the database in the temporary
+    # directory, not into the repository
+    tmp = os.path.dirname(database)
+    command = [
+        sys.executable,
+        os.path.join(HERE, "house_prices.py"),
+        "--database_name",
+        database,
+        "--city",
+        city,
+        "--reset_table",
+        "--no_cache",
+        "--api_base",
+        url,
+        "--workers",
+        str(workers),
+        "--rate",
+        "100000",
+        "--daily_quota",
+        "100000000",
+        "--cache_file",
+        os.path.join(tmp, "api_cache.db"),
+        "--metrics_json",
+        os.path.join(tmp, "ingest_report.json"),
+        "--metrics_prom",
+        os.path.join(tmp, "ingest_metrics.prom"),
+        "--period",
+        args.period,
+        "--num_periods",
+        str(args.num_periods),
+        "--bedrooms",
+    ]
+    command += args.bedrooms + ["--type"] + args.type + extra
+    env = dict(os.environ, DOMAIN_API_KEY="bench")
+    start = time.perf_counter()
+    result = subprocess.run(
+        command, env=env, cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        print(result.stdout.decode("utf-8", "replace")[-2000:])
+        sys.exit("house_prices.py failed")
+    return elapsed, result.stdout.decode("utf-8", "replace")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark house_prices.py ingest")
+    parser.add_argument("--city", type=str, default="Sydney")
+    parser.add_argument("--suburbs", type=int, default=650, help="Suburbs in the city")
+    parser.add_argument("--bedrooms", type=str, nargs="+", default=["1", "2", "3", "4"])
+    parser.add_argument("--type", type=str, nargs="+", default=["House", "Unit"])
+    parser.add_argument("--period", type=str, default="Quarters")
+    parser.add_argument("--num_periods", type=int, default=40)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--empty_rate", type=float, default=0.1)
+    parser.add_argument(
+        "--demographic",
+        action="store_true",
+        default=False,
+        help="Also benchmark the demographic ingest",
+    )
+    parser.add_argument(
+        "--show_output", action="store_true", default=False, help="Print run output"
+    )
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        empty_rate=args.empty_rate,
+    )
+    server, url = start_server(config)
+    combos = args.suburbs * len(args.bedrooms) * len(args.type)
+    print(
+        "{} suburbs, {} combos, latency {}s +{}s, error rate {}".format(
+            args.suburbs, combos, args.latency, args.jitter, args.error_rate
+        )
+    )
+    runs = [("performance", "--fill_table_performance")]
+    if args.demographic:
+        runs.append(("demographic", "--fill_demographic_table"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            for name, flag in runs:
+                database = os.path.join(tmp, "bench_{}_{}.db".format(name, workers))
+                seed_suburbs(database, args.city, args.suburbs)
+                elapsed, output = run_ingest(
+                    database, args.city, url, workers, args, [flag]
+                )
+                if name == "performance":
+                    table = "suburb_performance_{}_{}".format(args.city, args.period)
+                else:
+                    table = "suburb_demographic_{}".format(args.city)
+                rows = count(database, "SELECT COUNT(*) FROM {}".format(table))
+                done = count(
+                    database,
+                    "SELECT COUNT(*) FROM ingest_jobs WHERE status != 'pending'",
+                )
+                if args.show_output:
+                    print(output)
+                print(
+                    "{:>11} workers {:>3}: {:>6} jobs {:>8} rows in {:7.2f}s, "
+                    "{:8.1f} combos/s, {:9.0f} rows/s".format(
+                        name,
+                        workers,
+                        done,
+                        rows,
+                        elapsed,
+                        done / elapsed,
+                        rows / elapsed,
+                    )
+                )
+    server.shutdown()
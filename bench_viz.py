@@ -0,0 +1,196 @@
+# Dashboard data benchmark on a whole city. Compares the plain frames viz_app.py
+# used to filter with masks, the indexed in-memory model of --in_memory and the
+# queries pushed down to sqlite, then the plotly express build of the indicator
+# graph with figures.py, in full and downsampled, for growing selections, e.g.
+#
+#   python3 bench_viz.py Sydney --database_name housing.db --period Quarters
+import argparse
+import random
+import time
+
+import numpy as np
+import plotly.express as px
+import plotly.io as pio
+
+from data_access import MemoryStore, SqliteStore, add_date
+from figures import performance_figure
+
+
+def frame_memory(*frames):
+    return sum(
+        df.memory_usage(deep=True).sum() + df.index.memory_usage(deep=True)
+        for df in frames
+    )
+
+
+def express_figure(dff, x, ys):
+    # The indicator graph of viz_app.py before figures.py, one px.line per
+    # indicator
+    fig = px.line(
+        dff,
+        x=x,
+        y=ys[0],
+        color="bedrooms",
+        line_dash="suburb",
+        labels={"bedrooms": "Beds", "suburb": "Suburb"},
+    )
+    for var in ys[1:]:
+        fig2 = px.line(
+            dff, x=x, y=var, color="bedrooms", line_dash="suburb"
+        ).update_traces(mode="lines+markers")
+        for trace in fig2.data:
+            fig.add_trace(trace)
+    fig.update_layout(margin={"l": 40, "b": 40, "t": 10, "r": 0}, hovermode="closest")
+    fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
+    return fig
+
+
+def timed(func, selections):
+    times = []
+    rows = 0
+    for selection in selections:
+        start = time.perf_counter()
+        rows += len(func(*selection))
+        times.append(time.perf_counter() - start)
+    return np.array(times) * 1000, rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the dashboard data")
+    parser.add_argument("city", type=str, help="Name of city")
+    parser.add_argument(
+        "--database_name", type=str, default="housing.db", help="Name of sql database"
+    )
+    parser.add_argument("--period", type=str, default="Quarters")
+    parser.add_argument(
+        "--suburbs", type=int, default=10, help="Suburbs in every selection"
+    )
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument(
+        "--figure_suburbs",
+        type=int,
+        nargs="+",
+        default=[10, 50, 100],
+        help="Suburbs in the selections of the figure benchmark",
+    )
+    parser.add_argument("--figure_repeat", type=int, default=5)
+    parser.add_argument(
+        "--point_budget",
+        type=int,
+        default=2000,
+        help="Points of the downsampled figure",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    sqlite = SqliteStore(args.database_name, args.city, args.period)
+    start = time.perf_counter()
+    df = add_date(sqlite.load_performance())
+    df_demo = sqlite.load_demographic()
+    frame_load = time.perf_counter() - start
+    start = time.perf_counter()
+    memory = MemoryStore(sqlite)
+    memory_load = time.perf_counter() - start
+    print(
+        "{} {}: {} performance rows, {} demographic rows".format(
+            args.city, args.period, len(df), len(df_demo)
+        )
+    )
+    print(
+        "{:>8}: {:7.1f}MB, loaded in {:.2f}s".format(
+            "frame", frame_memory(df, df_demo) / 1e6, frame_load
+        )
+    )
+    print(
+        "{:>8}: {:7.1f}MB, loaded in {:.2f}s".format(
+            "memory", memory.memory_usage() / 1e6, memory_load
+        )
+    )
+
+    rng = random.Random(args.seed)
+    suburbs = sqlite.suburbs()
+    categories = sqlite.categories()
+    columns = ["suburb", "bedrooms", "year", "month", "medianSoldPrice"]
+    graphs = [
+        (
+            rng.sample(suburbs, min(args.suburbs, len(suburbs))),
+            rng.choice(["House", "Unit"]),
+            sorted(rng.sample([1, 2, 3, 4, 5], rng.randint(1, 3))),
+            columns,
+        )
+        for _ in range(args.repeat)
+    ]
+    pies = [(rng.choice(suburbs), rng.choice(categories)) for _ in range(args.repeat)]
+    tops = [pie + (5,) for pie in pies]
+
+    def frame_graph(filt, filt2, filt3, columns):
+        # The masks of update_graph before data_access.py
+        dff = df.loc[df["suburb"].isin(filt)]
+        dff = dff.loc[dff["bedrooms"].isin(filt3)]
+        return dff[dff["type"] == filt2][columns]
+
+    def frame_pie(subs, var):
+        dff = df_demo[df_demo["suburb"] == subs]
+        return dff[dff["category"] == var]
+
+    runs = [
+        ("graph", "frame", frame_graph, graphs),
+        ("graph", "memory", memory.read_performance, graphs),
+        ("graph", "sqlite", sqlite.read_performance, graphs),
+        ("pie", "frame", frame_pie, pies),
+        ("pie", "memory", memory.read_demographic, pies),
+        ("pie", "sqlite", sqlite.read_demographic, pies),
+        ("top", "memory", memory.read_demographic_top, tops),
+        ("top", "sqlite", sqlite.read_demographic_top, tops),
+    ]
+    for figure, name, func, selections in runs:
+        times, rows = timed(func, selections)
+        print(
+            "{:>5} {:>8}: median {:7.3f}ms, p95 {:7.3f}ms, {:6.0f} rows per call".format(
+                figure,
+                name,
+                np.median(times),
+                np.percentile(times, 95),
+                rows / len(selections),
+            )
+        )
+
+    # Figures as Dash sends them, built and serialized to JSON
+    ys = ["lowestSoldPrice", "medianSoldPrice", "highestSoldPrice"]
+    builders = [
+        ("express", lambda dff: express_figure(dff, "DATE", ys).to_json()),
+        (
+            "figures",
+            lambda dff: pio.to_json(
+                performance_figure(dff, "DATE", ys), validate=False
+            ),
+        ),
+        (
+            "lttb",
+            lambda dff: pio.to_json(
+                performance_figure(dff, "DATE", ys, args.point_budget), validate=False
+            ),
+        ),
+    ]
+    for count in args.figure_suburbs:
+        dff = memory.performance(
+            rng.sample(suburbs, min(count, len(suburbs))),
+            "House",
+            [2, 3, 4],
+            ["DATE"] + ys,
+        )
+        for name, build in builders:
+            times = []
+            for _ in range(args.figure_repeat):
+                start = time.perf_counter()
+                payload = build(dff)
+                times.append(time.perf_counter() - start)
+            print(
+                "{:>4} suburbs {:>8}: median {:8.1f}ms, {:7.0f}kB, {} rows".format(
+                    count,
+                    name,
+                    np.median(times) * 1000,
+                    len(payload) / 1024,
+                    len(dff),
+                )
+            )
@@ -0,0 +1,2 @@
+# The scripts live at the top of the repository, this puts them on the path
+# of the tests in tests/
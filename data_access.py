@@ -0,0 +1,599 @@
+# Read side of the data for viz_app.py. Filters and column selection are
+# pushed down to the sqlite database or to the Parquet export of
+# house_prices.py, so a callback only reads the rows of its figure and startup
+# does not depend on the size of the tables. Results are kept in a small LRU
+# cache, callers must not modify the frames they get back
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+FILTERS = ["state", "suburb", "postcode", "type", "bedrooms"]
+
+
+def latest_rows(df):
+    # Latest period of every suburb, type and bedrooms, for databases and
+    # exports from before house_prices.py kept the suburb_latest tables
+    return (
+        df.sort_values(["year", "month"])
+        .groupby(["suburb", "type", "bedrooms"], observed=True)
+        .tail(1)
+    )
+
+
+def ranked_rows(df, top=None):
+    # Subcategories of every suburb and category ranked by value with the
+    # remainder after each and the total, like the demographic_top tables of
+    # house_prices.py, for databases and exports from before it kept them
+    df = df.loc[~df["value"].isna(), ["suburb", "category", "subcategory", "value"]]
+    df = df.groupby(["suburb", "category", "subcategory"], observed=True).sum()
+    df = df.reset_index()
+    # Ties in name order, categoricals would sort in code order
+    df["subcategory"] = df["subcategory"].astype(str)
+    df = df.sort_values(
+        ["suburb", "category", "value", "subcategory"],
+        ascending=[True, True, False, True],
+        kind="stable",
+    )
+    groups = df.groupby(["suburb", "category"], observed=True, sort=False)["value"]
+    df["rank"] = groups.cumcount() + 1
+    df["total"] = groups.transform("sum")
+    df["rest"] = df["total"] - groups.cumsum()
+    if top is not None:
+        df = df[df["rank"] <= top]
+    columns = ["suburb", "category", "rank", "subcategory", "value", "rest", "total"]
+    return df[columns].reset_index(drop=True)
+
+
+def add_date(df):
+    df["DATE"] = pd.to_datetime(
+        pd.DataFrame({"year": df["year"], "month": df["month"], "day": 1})
+    )
+    return df
+
+
+def decode(ids, lookup_ids, names):
+    # Integer ids to a categorical through a lookup table sorted by id, NULL
+    # ids become NaN
+    codes, uniques = pd.factorize(names)
+    valid = ~np.isnan(ids)
+    positions = np.searchsorted(lookup_ids, ids[valid].astype(np.int64))
+    out = np.full(len(ids), -1, dtype=codes.dtype)
+    out[valid] = codes[positions]
+    return pd.Categorical.from_codes(out, uniques).remove_unused_categories()
+
+
+def compact(df, categories):
+    # Categoricals for the repeated names, numbers in the smallest type that
+    # holds every value exactly
+    for col in df.columns:
+        if col in categories:
+            df[col] = df[col].astype("category")
+        elif pd.api.types.is_integer_dtype(df[col]):
+            df[col] = pd.to_numeric(df[col], downcast="integer")
+        elif pd.api.types.is_float_dtype(df[col]):
+            values = df[col].to_numpy()
+            small = values.astype(np.float32)
+            if np.array_equal(small.astype(values.dtype), values, equal_nan=True):
+                df[col] = small
+    return df
+
+
+def placeholders(values):
+    return ", ".join("?" * len(values))
+
+
+class FrameCache:
+    # Least recently used frames up to size entries, shared by the threads
+    # serving callbacks
+    def __init__(self, size=64):
+        self.size = size
+        self.frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return self.frames[key]
+            self.misses += 1
+        frame = load()
+        with self.lock:
+            self.frames[key] = frame
+            self.frames.move_to_end(key)
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        return frame
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+
+
+class Store:
+    # Queries shared by the stores, subclasses read the rows. Inputs are
+    # normalized so that the same selection in another order hits the cache,
+    # and cached frames are keyed on the data version so writes invalidate them
+    def __init__(self, city, period, cache_size=64):
+        self.city = city
+        self.period = period
+        self.cache = FrameCache(cache_size)
+        self.columns = self.read_columns()
+        self.indicators = [col for col in self.columns if col not in FILTERS]
+        self.indicators.append("DATE")
+
+    def performance(self, suburbs, typ, bedrooms, columns):
+        # Rows of the suburbs, type and bedrooms with suburb, bedrooms and the
+        # indicator columns, DATE is built from year and month
+        suburbs = tuple(sorted(set(suburbs or [])))
+        bedrooms = tuple(sorted(set(int(bed) for bed in bedrooms or [])))
+        columns = tuple(dict.fromkeys(col for col in columns if col in self.indicators))
+        key = ("performance", self.data_version(), suburbs, typ, bedrooms, columns)
+
+        def load():
+            read = ["suburb", "bedrooms"]
+            for col in columns:
+                read += ["year", "month"] if col == "DATE" else [col]
+            df = self.read_performance(
+                suburbs, typ, bedrooms, list(dict.fromkeys(read))
+            )
+            return add_date(df) if "DATE" in columns else df
+
+        return self.cache.get(key, load)
+
+    def demographic(self, suburb, category):
+        # subcategory and value rows of one suburb and category
+        key = ("demographic", self.data_version(), suburb, category)
+        return self.cache.get(key, lambda: self.read_demographic(suburb, category))
+
+    def demographic_top(self, suburb, category, top):
+        # The top largest subcategory and value rows of one suburb and category,
+        # followed by an Other row with the rest
+        key = ("demographic_top", self.data_version(), suburb, category, int(top))
+
+        def load():
+            df = self.read_demographic_top(suburb, category, int(top))
+            rest = df["rest"].iloc[-1] if len(df) else 0
+            subcategories = [str(name) for name in df["subcategory"]]
+            values = list(df["value"])
+            # To display correct proportions in pie chart
+            if rest > 0:
+                subcategories.append("Other")
+                values.append(rest)
+            return pd.DataFrame({"subcategory": subcategories, "value": values})
+
+        return self.cache.get(key, load)
+
+    def latest(self, typ, bedrooms, column):
+        # suburb and column of the latest period of every suburb where column
+        # is known, empty while a dropdown of the map is cleared
+        if column not in self.columns or typ is None or bedrooms is None:
+            return pd.DataFrame({"suburb": [], column: []})
+        key = ("latest", self.data_version(), typ, int(bedrooms), column)
+        return self.cache.get(key, lambda: self.read_latest(typ, int(bedrooms), column))
+
+
+class SqliteStore(Store):
+    def __init__(self, database, city, period, cache_size=64):
+        self.database = database
+        self.local = threading.local()
+        self.table = "suburb_performance_{}_{}".format(city, period)
+        self.latest_table = "suburb_latest_{}_{}".format(city, period)
+        self.demographic_table = "suburb_demographic_{}".format(city)
+        self.top_table = "suburb_demographic_top_{}".format(city)
+        super().__init__(city, period, cache_size)
+        query = """SELECT COUNT(*) FROM sqlite_master WHERE name = ?"""
+        conn = self.connection()
+        self.has_latest = conn.execute(query, (self.latest_table,)).fetchone()[0] > 0
+        self.has_top = conn.execute(query, (self.top_table,)).fetchone()[0] > 0
+        fact_table = "demographic_facts_{}".format(city)
+        self.has_facts = conn.execute(query, (fact_table,)).fetchone()[0] > 0
+
+    def connection(self):
+        # sqlite connections can not be shared between threads, Dash serves
+        # callbacks from several
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.database)
+            self.local.conn = conn
+        return conn
+
+    def read_columns(self):
+        rows = self.connection().execute("PRAGMA table_info({})".format(self.table))
+        return [row[1] for row in rows]
+
+    def data_version(self):
+        # Sum of the write counts house_prices.py keeps for the tables, the
+        # latest table changes with the performance table
+        query = """SELECT COALESCE(SUM(version), 0) FROM data_version
+            WHERE name IN (?, ?, ?)"""
+        names = (self.table, self.demographic_table, self.top_table)
+        try:
+            row = self.connection().execute(query, names).fetchone()
+        except sqlite3.OperationalError:
+            # Written before house_prices.py counted versions
+            return 0
+        return row[0]
+
+    def suburbs(self):
+        table = self.latest_table if self.has_latest else self.table
+        query = """SELECT DISTINCT suburb FROM {} ORDER BY suburb""".format(table)
+        return [row[0] for row in self.connection().execute(query)]
+
+    def categories(self):
+        # Categories of this city, through the view or the plain table of
+        # databases that were not migrated yet
+        query = """SELECT DISTINCT category FROM {} ORDER BY category""".format(
+            self.demographic_table
+        )
+        return [row[0] for row in self.connection().execute(query)]
+
+    def read_performance(self, suburbs, typ, bedrooms, columns):
+        query = """SELECT {} FROM {} WHERE type = ? AND suburb IN ({})
+            AND bedrooms IN ({}) ORDER BY suburb, bedrooms, year, month""".format(
+            ", ".join(columns),
+            self.table,
+            placeholders(suburbs),
+            placeholders(bedrooms),
+        )
+        params = [typ] + list(suburbs) + list(bedrooms)
+        return pd.read_sql_query(query, self.connection(), params=params)
+
+    def read_demographic(self, suburb, category):
+        # Searched by the keys of the lookup tables and the fact table behind
+        # the view
+        query = """SELECT subcategory, value FROM {} WHERE suburb = ?
+            AND category = ?""".format(
+            self.demographic_table
+        )
+        return pd.read_sql_query(query, self.connection(), params=[suburb, category])
+
+    def read_demographic_top(self, suburb, category, top):
+        if self.has_top:
+            query = """SELECT subcategory, value, rest FROM {} WHERE suburb = ?
+                AND category = ? AND rank <= ? ORDER BY rank""".format(
+                self.top_table
+            )
+            params = [suburb, category, top]
+            return pd.read_sql_query(query, self.connection(), params=params)
+        query = """SELECT suburb, category, subcategory, value FROM {}
+            WHERE suburb = ? AND category = ?""".format(
+            self.demographic_table
+        )
+        df = pd.read_sql_query(query, self.connection(), params=[suburb, category])
+        return ranked_rows(df, top)
+
+    def load_performance(self):
+        query = """SELECT * FROM {}""".format(self.table)
+        return pd.read_sql_query(query, self.connection())
+
+    def load_demographic(self):
+        # Reads the integer coded rows behind the view straight into numpy, every
+        # name is read only once
+        conn = self.connection()
+        if not self.has_facts:
+            query = """SELECT suburb, year, category, subcategory, value, composition
+                FROM {}""".format(
+                self.demographic_table
+            )
+            return pd.read_sql_query(query, conn)
+        query = """SELECT suburb_id, year, subcategory_id, value, composition_id
+            FROM demographic_facts_{}""".format(
+            self.city
+        )
+        codes = np.array(conn.execute(query).fetchall(), dtype=np.float64)
+        codes = codes.reshape(-1, 5)
+        suburb_names = pd.read_sql_query(
+            "SELECT id, name FROM suburb_names ORDER BY id", conn
+        )
+        query = """SELECT sc.id, sc.name, c.name AS category
+            FROM demographic_subcategories sc
+            JOIN demographic_categories c ON c.id = sc.category_id ORDER BY sc.id"""
+        subcategories = pd.read_sql_query(query, conn)
+        compositions = pd.read_sql_query(
+            "SELECT id, name FROM demographic_compositions ORDER BY id", conn
+        )
+        subcategory_ids = subcategories["id"].to_numpy()
+        return pd.DataFrame(
+            {
+                "suburb": decode(
+                    codes[:, 0], suburb_names["id"].to_numpy(), suburb_names["name"]
+                ),
+                "year": codes[:, 1].astype(np.int32),
+                "category": decode(
+                    codes[:, 2], subcategory_ids, subcategories["category"]
+                ),
+                "subcategory": decode(
+                    codes[:, 2], subcategory_ids, subcategories["name"]
+                ),
+                "value": codes[:, 3],
+                "composition": decode(
+                    codes[:, 4], compositions["id"].to_numpy(), compositions["name"]
+                ),
+            }
+        )
+
+    def load_demographic_top(self, demographic):
+        if not self.has_top:
+            return ranked_rows(demographic)
+        query = """SELECT * FROM {}""".format(self.top_table)
+        return pd.read_sql_query(query, self.connection())
+
+    def load_latest(self, performance):
+        if not self.has_latest:
+            return latest_rows(performance)
+        query = """SELECT * FROM {}""".format(self.latest_table)
+        return pd.read_sql_query(query, self.connection())
+
+    def read_latest(self, typ, bedrooms, column):
+        if self.has_latest:
+            query = """SELECT suburb, {0} FROM {1} WHERE type = ? AND bedrooms = ?
+                AND {0} IS NOT NULL ORDER BY suburb""".format(
+                column, self.latest_table
+            )
+        else:
+            query = """SELECT suburb, {0} FROM (SELECT suburb, {0}, ROW_NUMBER()
+                OVER (PARTITION BY suburb ORDER BY year DESC, month DESC) AS age
+                FROM {1} WHERE type = ? AND bedrooms = ?)
+                WHERE age = 1 AND {0} IS NOT NULL ORDER BY suburb""".format(
+                column, self.table
+            )
+        return pd.read_sql_query(query, self.connection(), params=[typ, bedrooms])
+
+
+class ParquetStore(Store):
+    # Datasets written by house_prices.py --export_parquet. Only the row groups
+    # and columns a query needs are read, files are memory mapped
+    def __init__(self, directory, city, period, cache_size=64):
+        self.performance_data = self.dataset(directory, "performance_" + period)
+        self.demographic_data = self.dataset(directory, "demographic")
+        try:
+            self.latest_data = self.dataset(directory, "latest_" + period)
+        except FileNotFoundError:
+            self.latest_data = None
+        try:
+            self.top_data = self.dataset(directory, "demographic_top")
+        except FileNotFoundError:
+            self.top_data = None
+        super().__init__(city, period, cache_size)
+
+    @staticmethod
+    def dataset(directory, name):
+        import pyarrow.dataset as ds
+        from pyarrow import fs
+
+        return ds.dataset(
+            os.path.abspath(os.path.join(directory, name)),
+            format="parquet",
+            partitioning=ds.HivePartitioning.discover(infer_dictionary=True),
+            filesystem=fs.LocalFileSystem(use_mmap=True),
+        )
+
+    def read(self, data, columns, condition=None):
+        import pyarrow.dataset as ds
+
+        condition_city = ds.field("city") == self.city
+        if condition is not None:
+            condition_city = condition_city & condition
+        table = data.to_table(columns=columns, filter=condition_city)
+        return table.to_pandas()
+
+    def read_columns(self):
+        return [col for col in self.performance_data.schema.names if col != "city"]
+
+    def data_version(self):
+        # An export rewrites the files of the city
+        datasets = [
+            self.performance_data,
+            self.demographic_data,
+            self.latest_data,
+            self.top_data,
+        ]
+        try:
+            return max(
+                os.stat(path).st_mtime_ns
+                for data in datasets
+                if data is not None
+                for path in data.files
+            )
+        except (OSError, ValueError):
+            return 0
+
+    def suburbs(self):
+        data = self.latest_data
+        if data is None:
+            data = self.performance_data
+        df = self.read(data, ["suburb"])
+        return sorted(df["suburb"].astype(str).unique())
+
+    def categories(self):
+        df = self.read(self.demographic_data, ["category"])
+        return sorted(df["category"].astype(str).unique())
+
+    def read_performance(self, suburbs, typ, bedrooms, columns):
+        import pyarrow.dataset as ds
+
+        # isin can not bind an empty list
+        if not suburbs or not bedrooms:
+            return pd.DataFrame(columns=columns)
+        condition = (
+            (ds.field("type") == typ)
+            & ds.field("suburb").isin(list(suburbs))
+            & ds.field("bedrooms").isin(list(bedrooms))
+        )
+        df = self.read(self.performance_data, columns, condition)
+        order = [col for col in ["suburb", "bedrooms", "year", "month"] if col in df]
+        df = df.sort_values(order, kind="stable")
+        return df.reset_index(drop=True)
+
+    def read_demographic(self, suburb, category):
+        import pyarrow.dataset as ds
+
+        condition = (ds.field("suburb") == suburb) & (ds.field("category") == category)
+        return self.read(self.demographic_data, ["subcategory", "value"], condition)
+
+    def read_demographic_top(self, suburb, category, top):
+        import pyarrow.dataset as ds
+
+        condition = (ds.field("suburb") == suburb) & (ds.field("category") == category)
+        if self.top_data is None:
+            columns = ["suburb", "category", "subcategory", "value"]
+            return ranked_rows(
+                self.read(self.demographic_data, columns, condition), top
+            )
+        condition = condition & (ds.field("rank") <= top)
+        columns = ["rank", "subcategory", "value", "rest"]
+        df = self.read(self.top_data, columns, condition)
+        return df.sort_values("rank").reset_index(drop=True)
+
+    def load_performance(self):
+        return self.read(self.performance_data, self.columns)
+
+    def load_demographic(self):
+        names = self.demographic_data.schema.names
+        return self.read(self.demographic_data, [col for col in names if col != "city"])
+
+    def load_demographic_top(self, demographic):
+        if self.top_data is None:
+            return ranked_rows(demographic)
+        names = self.top_data.schema.names
+        return self.read(self.top_data, [col for col in names if col != "city"])
+
+    def load_latest(self, performance):
+        if self.latest_data is None:
+            return latest_rows(performance)
+        return self.read(self.latest_data, self.columns)
+
+    def read_latest(self, typ, bedrooms, column):
+        import pyarrow.dataset as ds
+
+        condition = (ds.field("type") == typ) & (ds.field("bedrooms") == bedrooms)
+        if self.latest_data is not None:
+            df = self.read(self.latest_data, ["suburb", column], condition)
+        else:
+            df = self.read(
+                self.performance_data,
+                ["suburb", "type", "bedrooms", "year", "month", column],
+                condition,
+            )
+            df = latest_rows(df)[["suburb", column]]
+        df = df[~df[column].isna()]
+        return df.sort_values("suburb").reset_index(drop=True)
+
+
+class MemoryStore(Store):
+    # The whole city loaded once from another store. Names are categoricals,
+    # numbers are downcast and the rows are sorted by a MultiIndex, so the
+    # filters of the callbacks are index slices instead of masks over strings
+    def __init__(self, source, cache_size=64):
+        self.source = source
+        # The rows do not change once loaded
+        self.version = source.data_version()
+        super().__init__(source.city, source.period, cache_size)
+        performance = source.load_performance()
+        latest = source.load_latest(performance)
+        performance = add_date(compact(performance, ["state", "suburb", "type"]))
+        # The index columns are kept as columns too, slices are taken from them
+        self.performance_frame = performance.set_index(
+            ["type", "suburb", "bedrooms", "DATE"], drop=False
+        ).sort_index()
+        demographic = source.load_demographic()
+        top = compact(
+            source.load_demographic_top(demographic),
+            ["suburb", "category", "subcategory"],
+        )
+        self.top_frame = top.set_index(["suburb", "category", "rank"]).sort_index()
+        demographic = compact(
+            demographic, ["suburb", "category", "subcategory", "composition"]
+        )
+        self.demographic_frame = demographic.set_index(
+            ["suburb", "category"]
+        ).sort_index()
+        latest = compact(latest, ["state", "suburb", "type"])
+        self.latest_frame = latest.set_index(["type", "bedrooms"]).sort_index()
+
+    def read_columns(self):
+        return self.source.columns
+
+    def data_version(self):
+        return self.version
+
+    def memory_usage(self):
+        return sum(
+            df.memory_usage(deep=True).sum() + df.index.memory_usage(deep=True)
+            for df in [
+                self.performance_frame,
+                self.demographic_frame,
+                self.top_frame,
+                self.latest_frame,
+            ]
+        )
+
+    def suburbs(self):
+        return sorted(self.performance_frame.index.levels[1].astype(str))
+
+    def categories(self):
+        return sorted(self.demographic_frame.index.levels[1].astype(str))
+
+    def read_performance(self, suburbs, typ, bedrooms, columns):
+        # A list with a label missing from the index would fail the whole slice
+        levels = self.performance_frame.index.levels
+        suburbs = [suburb for suburb in suburbs if suburb in levels[1]]
+        bedrooms = [bed for bed in bedrooms if bed in levels[2]]
+        if typ not in levels[0] or not suburbs or not bedrooms:
+            return pd.DataFrame(columns=columns)
+        frame = self.performance_frame
+        positions = frame.index.get_locs([typ, suburbs, bedrooms])
+        df = pd.DataFrame({col: frame[col].array.take(positions) for col in columns})
+        df["suburb"] = df["suburb"].cat.remove_unused_categories()
+        return df
+
+    def read_demographic(self, suburb, category):
+        # The rows of a key are one slice of the sorted frame
+        frame = self.demographic_frame
+        try:
+            rows = frame.index.get_loc((suburb, category))
+        except KeyError:
+            return pd.DataFrame(columns=["subcategory", "value"])
+        return pd.DataFrame(
+            {col: frame[col].array[rows] for col in ["subcategory", "value"]}
+        )
+
+    def read_demographic_top(self, suburb, category, top):
+        # The ranks of a key are one slice, the first top of them are taken
+        frame = self.top_frame
+        try:
+            rows = frame.index.get_loc((suburb, category))
+        except KeyError:
+            return pd.DataFrame(columns=["subcategory", "value", "rest"])
+        rows = slice(rows.start, min(rows.stop, rows.start + top))
+        return pd.DataFrame(
+            {col: frame[col].array[rows] for col in ["subcategory", "value", "rest"]}
+        )
+
+    def read_latest(self, typ, bedrooms, column):
+        try:
+            df = self.latest_frame.loc[(typ, bedrooms), :]
+        except KeyError:
+            return pd.DataFrame(columns=["suburb", column])
+        df = df.loc[~df[column].isna(), ["suburb", column]]
+        df["suburb"] = df["suburb"].astype(str)
+        return df.sort_values("suburb").reset_index(drop=True)
+
+
+def open_store(
+    city, period, database=None, parquet_dir=None, cache_size=64, in_memory=False
+):
+    if parquet_dir:
+        store = ParquetStore(parquet_dir, city, period, cache_size)
+    else:
+        store = SqliteStore(database, city, period, cache_size)
+    if in_memory:
+        return MemoryStore(store, cache_size)
+    return store
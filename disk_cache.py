@@ -0,0 +1,109 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class DiskCache:
+    # Compressed key/value store on disk, entries are addressed by the sha256 of
+    # their key and evicted least recently used first once the cache is over
+    # max_bytes. Safe to share between threads and processes.
+    def __init__(self, path, max_bytes=512 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.puts = 0
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            namespace TEXT,
+            source TEXT,
+            value BLOB,
+            size INTEGER,
+            created_at REAL,
+            accessed_at REAL
+            );"""
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def address(key):
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key, ttl=None):
+        # Returns the stored bytes, or None if missing or older than ttl seconds
+        address = self.address(key)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created_at FROM cache WHERE key = ?", (address,)
+            ).fetchone()
+            if row is None:
+                return None
+            if ttl is not None and now - row[1] > ttl:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (address,))
+                self.conn.commit()
+                return None
+            self.conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, address)
+            )
+            self.conn.commit()
+        return zlib.decompress(row[0])
+
+    def set(self, key, value, namespace=""):
+        blob = zlib.compress(value, 6)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?,?,?,?,?,?,?)",
+                (self.address(key), namespace, key, blob, len(blob), now, now),
+            )
+            self.conn.commit()
+            self.puts = self.puts + 1
+            check = self.puts % 100 == 0
+        if check:
+            self.evict()
+
+    def size(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache"
+            ).fetchone()[0]
+
+    def evict(self):
+        # Drops least recently used entries until the cache fits in max_bytes
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM cache"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            rows = self.conn.execute(
+                "SELECT key, size FROM cache ORDER BY accessed_at"
+            ).fetchall()
+            drop = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                drop.append((key,))
+                total = total - size
+            self.conn.executemany("DELETE FROM cache WHERE key = ?", drop)
+            self.conn.commit()
+        return len(drop)
+
+    def clear(self, namespace=None):
+        with self.lock:
+            if namespace is None:
+                self.conn.execute("DELETE FROM cache")
+            else:
+                self.conn.execute("DELETE FROM cache WHERE namespace = ?", (namespace,))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
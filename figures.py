@@ -0,0 +1,226 @@
+# Figure builders for viz_app.py. Traces are plain dicts filled with numpy
+# arrays in one pass over the rows, without a plotly express build per
+# indicator or the validation of graph_objects
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.io as pio
+
+COLORS = px.colors.qualitative.Plotly
+DASHES = ["solid", "dot", "dash", "longdash", "dashdot", "longdashdot"]
+# Same look as the plotly express figures, the template is only built once
+TEMPLATE = pio.templates["plotly"].to_plotly_json()
+
+
+def axis_values(values):
+    # Dates as ISO strings, the JSON encoder would write datetime64 as integers
+    if np.issubdtype(values.dtype, np.datetime64):
+        return np.datetime_as_string(values, unit="D")
+    return values
+
+
+def zoom_range(relayout):
+    # x range of a zoom or pan in the relayoutData of a graph, None once the
+    # axis is autoscaled again
+    relayout = relayout or {}
+    if "xaxis.range[0]" in relayout and "xaxis.range[1]" in relayout:
+        return [relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]]
+    if "xaxis.range" in relayout:
+        return list(relayout["xaxis.range"])
+    return None
+
+
+def lttb(xs, ys, lengths, threshold):
+    # Largest-Triangle-Three-Buckets over many series at once, xs and ys hold
+    # one series per row padded to the longest. Keeps the first and the last
+    # point and from every bucket between them the point making the largest
+    # triangle with the point kept before it and the mean of the next bucket.
+    # Returns the threshold positions kept in every row
+    series = np.arange(len(xs))
+    every = (lengths - 2) / (threshold - 2)
+    # Running sums for the bucket means, a missing y is left out of them
+    known = ~np.isnan(ys)
+    zeros = np.zeros((len(xs), 1))
+    x_sum = np.hstack([zeros, np.cumsum(np.where(known, xs, 0), axis=1)])
+    y_sum = np.hstack([zeros, np.cumsum(np.where(known, ys, 0), axis=1)])
+    counts = np.hstack([zeros, np.cumsum(known, axis=1)])
+    keep = np.zeros((len(xs), threshold), dtype=np.int64)
+    keep[:, -1] = lengths - 1
+    kept = keep[:, 0]
+    for bucket in range(threshold - 2):
+        start = np.floor(bucket * every).astype(np.int64) + 1
+        end = np.floor((bucket + 1) * every).astype(np.int64) + 1
+        after = np.minimum(np.floor((bucket + 2) * every).astype(np.int64) + 1, lengths)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            size = counts[series, after] - counts[series, end]
+            cx = (x_sum[series, after] - x_sum[series, end]) / size
+            cy = (y_sum[series, after] - y_sum[series, end]) / size
+        candidates = start[:, None] + np.arange((end - start).max())
+        valid = candidates < end[:, None]
+        candidates = np.minimum(candidates, lengths[:, None] - 1)
+        bx = xs[series[:, None], candidates]
+        by = ys[series[:, None], candidates]
+        ax = xs[series, kept][:, None]
+        ay = ys[series, kept][:, None]
+        area = np.abs((ax - cx[:, None]) * (by - ay) - (ax - bx) * (cy[:, None] - ay))
+        area = np.where(valid & ~np.isnan(area), area, -1)
+        kept = candidates[series, np.argmax(area, axis=1)]
+        keep[:, bucket + 1] = kept
+    return keep
+
+
+def downsample(groups, xs, values, n, point_budget):
+    # Cuts the series of groups, positions into the long format, down to about
+    # point_budget points in all, with the same number for every long series
+    threshold = max(3, point_budget // len(groups))
+    long = [i for i, rows in enumerate(groups) if len(rows) > threshold]
+    if not long:
+        return groups
+    lengths = np.array([len(groups[i]) for i in long])
+    flat = np.concatenate([groups[i] for i in long])
+    series = np.repeat(np.arange(len(long)), lengths)
+    offsets = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded_x = np.full((len(long), lengths.max()), np.nan)
+    padded_y = np.full((len(long), lengths.max()), np.nan)
+    padded_x[series, offsets] = xs[flat % n]
+    padded_y[series, offsets] = values[flat]
+    keep = lttb(padded_x, padded_y, lengths, threshold)
+    groups = list(groups)
+    for i, positions in zip(long, keep):
+        groups[i] = groups[i][positions]
+    return groups
+
+
+def performance_figure(dff, x, ys, point_budget=None, x_range=None):
+    # One trace per indicator, bedrooms and suburb of dff. The colour follows
+    # the bedrooms and the dash the suburb like px.line(color="bedrooms",
+    # line_dash="suburb"), indicators after the first get markers. The legend
+    # lists every bedrooms and suburb once, clicking it toggles all their
+    # indicators.
+    # On a time axis only the rows in x_range are drawn, and every series is
+    # downsampled so the figure has about point_budget points
+    n = len(dff)
+    raw = dff[x].to_numpy()
+    xs = axis_values(raw)
+    time_axis = np.issubdtype(raw.dtype, np.datetime64)
+    suburbs = dff["suburb"].astype(str).to_numpy()
+    bedrooms = dff["bedrooms"].to_numpy()
+    # Long format, the rows of every indicator one after the other
+    values = np.concatenate(
+        [dff[y].to_numpy(dtype=np.float64) for y in ys] + [np.empty(0)]
+    )
+    # Traces in the order of plotly express, by bedrooms and then suburb in
+    # order of appearance
+    bed_codes, bed_values = pd.factorize(bedrooms)
+    suburb_codes, suburb_values = pd.factorize(suburbs)
+    combo, combos = pd.factorize(
+        bed_codes * len(suburb_values) + suburb_codes, sort=True
+    )
+    group = np.tile(combo, len(ys)) + np.repeat(np.arange(len(ys)), n) * len(combos)
+    order = np.argsort(group, kind="stable")
+    if time_axis and x_range is not None:
+        # The point either side of the range too, so lines run to its edges
+        ordered = raw[order % n]
+        inside = (ordered >= np.datetime64(pd.Timestamp(x_range[0]))) & (
+            ordered <= np.datetime64(pd.Timestamp(x_range[1]))
+        )
+        near = inside.copy()
+        near[1:] |= inside[:-1]
+        near[:-1] |= inside[1:]
+        order = order[near]
+    starts = np.flatnonzero(np.diff(group[order], prepend=-1))
+    groups = np.split(order, starts[1:]) if len(order) and ys else []
+    if time_axis and point_budget and len(order) > point_budget:
+        days = raw.astype("datetime64[D]").astype(np.float64)
+        groups = downsample(groups, days, values, n, point_budget)
+
+    traces = []
+    for rows in groups:
+        variable, index = divmod(group[rows[0]], len(combos))
+        bed_index, suburb_index = divmod(combos[index], len(suburb_values))
+        bed = bed_values[bed_index]
+        suburb = suburb_values[suburb_index]
+        color = COLORS[bed_index % len(COLORS)]
+        name = "{}, {}".format(bed, suburb)
+        traces.append(
+            {
+                "type": "scatter",
+                "mode": "lines" if variable == 0 else "lines+markers",
+                "name": name,
+                "legendgroup": name,
+                "showlegend": bool(variable == 0),
+                "x": xs[rows % n],
+                "y": values[rows],
+                "line": {"color": color, "dash": DASHES[suburb_index % len(DASHES)]},
+                "marker": {"color": color},
+                "hovertemplate": "Beds={}<br>Suburb={}<br>{}=%{{x}}<br>{}=%{{y}}"
+                "<extra></extra>".format(bed, suburb, x, ys[variable]),
+            }
+        )
+    layout = performance_layout(x, ys)
+    if time_axis and x_range is not None:
+        layout["xaxis"]["range"] = list(x_range)
+    return {"data": traces, "layout": layout}
+
+
+def performance_layout(x, ys):
+    return {
+        "template": TEMPLATE,
+        "xaxis": {"title": {"text": x}},
+        "yaxis": {"title": {"text": ys[0] if ys else ""}},
+        "legend": {
+            "title": {"text": "Beds, Suburb"},
+            "tracegroupgap": 0,
+            "yanchor": "top",
+            "y": 0.99,
+            "xanchor": "left",
+            "x": 0.01,
+        },
+        "margin": {"l": 40, "b": 40, "t": 10, "r": 0},
+        "hovermode": "closest",
+        # Keeps the zoom while the same x axis is redrawn
+        "uirevision": x,
+    }
+
+
+def json_values(values):
+    # Whole numbers without a fraction and missing values as null, the
+    # shortest JSON for the prices and counts
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    if np.array_equal(values[known], np.round(values[known])):
+        values = np.where(known, values, 0).astype(np.int64)
+    return [value if ok else None for value, ok in zip(values.tolist(), known)]
+
+
+def performance_slice(dff, typ, columns):
+    # The rows of one type for the clientside figure of viz_app.py, column by
+    # column. The rows are sorted by suburb and bedrooms, so those are sent as
+    # runs of rows with a code into the suburb names. DATE is a count of
+    # months. assets/price_explorer.js draws the same traces as
+    # performance_figure from it
+    suburbs, names = pd.factorize(dff["suburb"].astype(str))
+    bedrooms = dff["bedrooms"].astype(int).to_numpy()
+    starts = np.flatnonzero(
+        np.diff(suburbs, prepend=-1) | np.diff(bedrooms, prepend=-1)
+    )
+    data = {
+        "type": typ,
+        "suburbs": list(names),
+        "runs": {
+            "suburb": suburbs[starts].tolist(),
+            "bedrooms": bedrooms[starts].tolist(),
+            "length": np.diff(np.append(starts, len(dff))).tolist(),
+        },
+        "columns": {},
+        "colors": COLORS,
+        "dashes": DASHES,
+        "layout": performance_layout(None, []),
+    }
+    for col in columns:
+        if col == "DATE":
+            months = dff["year"].astype(int) * 12 + dff["month"].astype(int) - 1
+            data["columns"][col] = months.tolist()
+        else:
+            data["columns"][col] = json_values(dff[col])
+    return data
@@ -0,0 +1,163 @@
+# Prepares the suburb boundaries for the map of viz_app.py. Reads a full
+# state GeoJSON once, keeps the suburbs of a city, simplifies them and writes
+# geo/<city>.geojson with one feature per suburb whose id is the suburb name
+# used in the database, e.g.
+#
+#   python3 geo_prep.py Sydney --source ../nsw.geojson --database_name housing.db
+#
+# The file is only rebuilt when the source, the suburbs of the city or the
+# settings change.
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+import shapely
+from shapely.geometry import mapping, shape
+
+from house_prices import normalize_name
+
+
+def city_suburbs(database, city):
+    conn = sqlite3.connect(database)
+    try:
+        query = """SELECT DISTINCT suburb_name FROM suburbs_{}""".format(city)
+        return [row[0] for row in conn.execute(query)]
+    finally:
+        conn.close()
+
+
+def round_coordinates(coords, digits):
+    # 5 digits are about 1m, far finer than the map is drawn at
+    if isinstance(coords[0], (int, float)):
+        return [round(value, digits) for value in coords]
+    return [round_coordinates(part, digits) for part in coords]
+
+
+def simplify(geometries, tolerance):
+    # Borders shared by two suburbs are simplified once, so neighbours still
+    # meet without gaps or overlaps. Older shapely only keeps every polygon
+    # valid on its own
+    if hasattr(shapely, "coverage_simplify"):
+        try:
+            return list(shapely.coverage_simplify(geometries, tolerance))
+        except shapely.errors.GEOSException:
+            pass
+    return [geom.simplify(tolerance, preserve_topology=True) for geom in geometries]
+
+
+def prepare(source, suburbs, name_property, tolerance, digits):
+    with open(source) as f:
+        data = json.load(f)
+    index = {normalize_name(name): name for name in suburbs}
+    parts = {}
+    for feature in data["features"]:
+        name = index.get(normalize_name(feature["properties"].get(name_property) or ""))
+        if name is not None:
+            parts.setdefault(name, []).append(shape(feature["geometry"]))
+    names = sorted(parts)
+    # A suburb can be split over several features
+    geometries = [shapely.union_all(parts[name]) for name in names]
+    geometries = simplify(geometries, tolerance)
+    features = []
+    for name, geom in zip(names, geometries):
+        geometry = mapping(geom)
+        geometry = {
+            "type": geometry["type"],
+            "coordinates": round_coordinates(geometry["coordinates"], digits),
+        }
+        features.append(
+            {
+                "type": "Feature",
+                "id": name,
+                "properties": {"name": name},
+                "geometry": geometry,
+            }
+        )
+    xmin, ymin, xmax, ymax = shapely.total_bounds(geometries)
+    center = {"lat": (ymin + ymax) / 2, "lon": (xmin + xmax) / 2}
+    missing = sorted(set(suburbs) - set(names))
+    return {"type": "FeatureCollection", "features": features}, center, missing
+
+
+def build(city, source, database, output, name_property, tolerance, digits):
+    # Returns the path of the GeoJSON of city, rebuilt only if it is missing or
+    # was made from another source file, suburb list or with other settings
+    suburbs = city_suburbs(database, city)
+    settings = {
+        "source": os.path.abspath(source),
+        "source_mtime": os.path.getmtime(source),
+        "name_property": name_property,
+        "tolerance": tolerance,
+        "digits": digits,
+        # A --get_suburbs run of house_prices.py can change the suburbs
+        "suburbs": hashlib.sha256(
+            "\n".join(sorted(suburbs)).encode("utf-8")
+        ).hexdigest(),
+    }
+    meta_path = output + ".meta.json"
+    if os.path.exists(output) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("settings") == settings:
+            print("{} is up to date".format(output))
+            return output
+
+    start = time.perf_counter()
+    geojson, center, missing = prepare(
+        source, suburbs, name_property, tolerance, digits
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(geojson, f, separators=(",", ":"))
+    with open(meta_path, "w") as f:
+        json.dump({"settings": settings, "center": center, "missing": missing}, f)
+    print(
+        "{}: {} suburbs, {} without boundaries, {:.0f}kB in {:.2f}s".format(
+            output,
+            len(geojson["features"]),
+            len(missing),
+            os.path.getsize(output) / 1024,
+            time.perf_counter() - start,
+        )
+    )
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prepare suburb boundaries")
+    parser.add_argument("city", type=str, help="Name of city")
+    parser.add_argument(
+        "--source", type=str, required=True, help="GeoJSON of all suburbs of a state"
+    )
+    parser.add_argument(
+        "--database_name", type=str, default="housing.db", help="Name of sql database"
+    )
+    parser.add_argument(
+        "--name_property",
+        type=str,
+        default="nsw_loca_2",
+        help="Feature property holding the suburb name",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.0005,
+        help="Simplification tolerance in degrees, about 50m",
+    )
+    parser.add_argument("--digits", type=int, default=5, help="Coordinate decimals")
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    output = args.output or os.path.join("geo", args.city + ".geojson")
+    build(
+        args.city,
+        args.source,
+        args.database_name,
+        output,
+        args.name_property,
+        args.tolerance,
+        args.digits,
+    )
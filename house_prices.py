@@ -1,48 +1,705 @@
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import sys
 import sqlite3
-import pickle as pkl
 import argparse
-from API_KEY import API_KEY
 import time
+import datetime
+import os
+import socket
+import threading
+import json
+import random
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from disk_cache import DiskCache
+from metrics import Metrics
+import queue
+import re
+import difflib
+import unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-URL_ADD = "https://api.domain.com.au/v1/addressLocators?searchLevel=Suburb&suburb={}&state=NSW&postcode={}"
-URL_PERF = "https://api.domain.com.au/v2/suburbPerformanceStatistics/{}/{}/{}?propertyCategory={}&bedrooms={}&periodSize={}&startingPeriodRelativeToCurrent={}&totalPeriods={}"
-URL_DEM = "https://api.domain.com.au/v2/demographics/{}/{}/{}?types=AgeGroupOfPopulation%2CCountryOfBirth%2CNatureOfOccupancy%2COccupation%2CGeographicalPopulation%2CGeographicalPopulation%2CEducationAttendance%2CHousingLoanRepayment%2CMaritalStatus%2CReligion%2CTransportToWork%2CFamilyComposition%2CHouseholdIncome%2CRent%2CLabourForceStatus&year={}"
+try:
+    from API_KEY import API_KEY
+except ImportError:
+    API_KEY = os.environ.get("DOMAIN_API_KEY")
+
+# DOMAIN_API_BASE or --api_base point the script at another server, e.g.
+# mock_domain_api.py
+API_BASE = os.environ.get("DOMAIN_API_BASE", "https://api.domain.com.au")
+URL_ADD = (
+    API_BASE + "/v1/addressLocators?searchLevel=Suburb&suburb={}&state=NSW&postcode={}"
+)
+URL_PERF = (
+    API_BASE
+    + "/v2/suburbPerformanceStatistics/{}/{}/{}?propertyCategory={}&bedrooms={}&periodSize={}&startingPeriodRelativeToCurrent={}&totalPeriods={}"
+)
+URL_DEM = (
+    API_BASE
+    + "/v2/demographics/{}/{}/{}?types=AgeGroupOfPopulation%2CCountryOfBirth%2CNatureOfOccupancy%2COccupation%2CGeographicalPopulation%2CGeographicalPopulation%2CEducationAttendance%2CHousingLoanRepayment%2CMaritalStatus%2CReligion%2CTransportToWork%2CFamilyComposition%2CHouseholdIncome%2CRent%2CLabourForceStatus&year={}"
+)
 state_map = {"Sydney": "NSW", "Melbourne": "VIC"}
+period_months = {"Years": 12, "HalfYears": 6, "Quarters": 3}
+# Bump when the layout of the data tables changes, --migrate upgrades old
+# databases to this version
+SCHEMA_VERSION = 2
+# How each quarterly value is combined into a longer period, weighted values
+# are volume weighted means which only approximate the true median/percentiles
+ROLLUP = {
+    "medianSoldPrice": ("weighted", "numberSold"),
+    "numberSold": ("sum", None),
+    "highestSoldPrice": ("max", None),
+    "lowestSoldPrice": ("min", None),
+    "FifthPercentileSoldPrice": ("weighted", "numberSold"),
+    "TwentyFivePercentileSoldPrice": ("weighted", "numberSold"),
+    "SeventyFivePercentileSoldPrice": ("weighted", "numberSold"),
+    "NintyFivePercentileSoldPrice": ("weighted", "numberSold"),
+    "medianSaleListingPrice": ("weighted", "numberSaleListing"),
+    "numberSaleListing": ("sum", None),
+    "highestSaleListingPrice": ("max", None),
+    "lowestSaleListingPrice": ("min", None),
+    "auctionNumberAuctioned": ("sum", None),
+    "auctionNumberSold": ("sum", None),
+    "auctionNumberWithdrawn": ("sum", None),
+    "daysOnMarket": ("weighted", "numberSold"),
+    "discountPercentage": ("weighted", "numberSold"),
+    "medianRentListingPrice": ("weighted", "numberRentListing"),
+    "numberRentListing": ("sum", None),
+    "highestRentListingPrice": ("max", None),
+    "lowestRentListingPrice": ("min", None),
+}
+PERFORMANCE_KEY = ["state", "suburb", "postcode", "type", "bedrooms", "year", "month"]
+LATEST_KEY = ["suburb", "type", "bedrooms"]
+# Subcategories of every suburb and category kept for the pie charts
+DEMOGRAPHIC_TOP = 10
+# Seconds a cached API response stays valid, None never expires
+# Census demographics only change every five years
+CACHE_TTL = {"performance": 7 * 24 * 3600, "demographic": None}
+limiter = None
+cache = None
+cache_only = False
+# Status of a call --cache_only could not answer, its job stays pending
+NOT_CACHED = "not cached"
+session = None
+# (connect, read) timeout in seconds
+TIMEOUT = (5, 30)
+RETRIES = 3
+BACKOFF = 1.0
+# Longer Retry-After waits mean the daily quota is gone, stop instead
+MAX_RETRY_AFTER = 120
+# Timings, status codes, quota and row counts of this run, written out as a
+# JSON report and a Prometheus text file at the end
+metrics = Metrics()
+
+
+class RateLimiter:
+    # Token bucket for the per-second limit plus a hard cap on calls per day,
+    # we are only allowed 500 API calls per day. With a database the calls of
+    # every run and process on the same day are counted in api_quota, and a
+    # run gets what is left of the day. With shares that is split between
+    # cities by weight, and what a finished city did not use is handed to the
+    # cities still fetching
+    def __init__(self, rate, burst=1, daily_quota=500, shares=None, database=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.daily_quota = daily_quota
+        self.db = None
+        if database is not None and daily_quota is not None:
+            # Only used with the lock held, by whichever thread takes quota
+            self.db = sqlite3.connect(
+                database, timeout=60, check_same_thread=False, isolation_level=None
+            )
+            query = """CREATE TABLE IF NOT EXISTS api_quota (
+                day TEXT PRIMARY KEY,
+                used INTEGER NOT NULL
+                );"""
+            self.db.execute(query)
+            daily_quota = max(0, daily_quota - self.used_today())
+        # Calls this run may make
+        self.budget = daily_quota
+        self.shares = shares or {}
+        self.used = 0
+        self.used_by = Counter()
+        self.finished = set()
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allowance(self, city):
+        # Calls city may make, call with the lock held
+        if self.budget is None or city not in self.shares:
+            return self.budget
+        total = sum(self.shares.values())
+
+        def base(name):
+            return self.budget * self.shares[name] / total
+
+        # A finished city may still have calls in flight, it keeps its place
+        # among the active ones. The cap on the whole run stops overspending
+        done = self.finished - {city}
+        spare = sum(max(0, base(c) - self.used_by[c]) for c in done)
+        active = sum(w for c, w in self.shares.items() if c not in done)
+        if active == 0:
+            return base(city)
+        return base(city) + spare * self.shares[city] / active
+
+    def used_today(self):
+        row = self.db.execute(
+            "SELECT used FROM api_quota WHERE day = ?", (self.today(),)
+        ).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def today():
+        return datetime.date.today().isoformat()
+
+    def spend_today(self):
+        # Counts one call against the day unless other runs used it up, in one
+        # write transaction so parallel processes never overspend
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if self.used_today() >= self.daily_quota:
+                self.db.execute("ROLLBACK")
+                return False
+            query = """INSERT INTO api_quota VALUES (?, 1) ON CONFLICT (day)
+                DO UPDATE SET used = used + 1"""
+            self.db.execute(query, (self.today(),))
+            self.db.execute("COMMIT")
+            return True
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def take_quota(self, city=None):
+        with self.lock:
+            if self.budget is not None and self.used >= self.budget:
+                return False
+            if city is not None and self.used_by[city] >= self.allowance(city):
+                return False
+            if self.db is not None and not self.spend_today():
+                return False
+            self.used = self.used + 1
+            self.used_by[city] += 1
+            return True
+
+    def finish(self, city):
+        with self.lock:
+            self.finished.add(city)
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def make_session(pool_size=10):
+    # Keeps connections alive between calls so TLS handshakes are reused
+    new_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    return new_session
+
+
+def record_quota(response):
+    # The API reports its own view of the daily quota on every response
+    for header, name in [
+        ("X-Quota-PerDay-Limit", "api_quota_limit"),
+        ("X-Quota-PerDay-Remaining", "api_quota_remaining"),
+    ]:
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            metrics.set(name, int(value))
+        except ValueError:
+            pass
+
+
+def retry_after(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, BACKOFF * 2**attempt)
+
+
+def http_get(URL, endpoint, headers=None, before=None):
+    # GET with timeouts, retries on connection errors and 5xx, and waiting out
+    # short Retry-After on 429. Raises the last error if every attempt failed.
+    # before is called ahead of every attempt, when it returns False no more
+    # attempts are made and the last response or error is returned, None if
+    # there was none
+    global session
+    if session is None:
+        session = make_session()
+    response = None
+    error = None
+    for attempt in range(RETRIES + 1):
+        if before is not None and not before():
+            if error is not None:
+                raise error
+            return response
+        start = time.perf_counter()
+        try:
+            response = session.get(URL, headers=headers, timeout=TIMEOUT)
+            error = None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.inc("http_requests_total", endpoint=endpoint, code="error")
+            if attempt == RETRIES:
+                raise
+            error = e
+            metrics.inc("http_retries_total", endpoint=endpoint)
+            time.sleep(backoff(attempt))
+            continue
+        finally:
+            metrics.observe(
+                "http_seconds", time.perf_counter() - start, endpoint=endpoint
+            )
+        metrics.inc("http_requests_total", endpoint=endpoint, code=response.status_code)
+        metrics.inc("http_bytes_total", len(response.content), endpoint=endpoint)
+        record_quota(response)
+        if attempt == RETRIES:
+            return response
+        if response.status_code == 429:
+            wait_for = retry_after(response)
+            if wait_for is None or wait_for > MAX_RETRY_AFTER:
+                return response
+            print("Rate limited, retrying in {:.0f}s".format(wait_for))
+        elif response.status_code >= 500:
+            wait_for = backoff(attempt)
+        else:
+            return response
+        metrics.inc("http_retries_total", endpoint=endpoint)
+        time.sleep(wait_for)
+
+
+def print_metrics():
+    report = metrics.report()
+    for entry in report["counters"] + report["gauges"]:
+        print(
+            "{} {}: {}".format(entry["name"], entry["labels"], round(entry["value"], 2))
+        )
+    for entry in report["histograms"]:
+        summary = entry["value"]
+        print(
+            "{} {}: {} calls, {:.2f}s, mean {:.4f}s, p95 <= {}s".format(
+                entry["name"],
+                entry["labels"],
+                summary["count"],
+                summary["sum"],
+                summary["mean"],
+                summary["p95"],
+            )
+        )
+
+
+def write_metrics(json_path, prom_path, args):
+    if limiter is not None:
+        metrics.set("api_quota_used", limiter.used)
+        if limiter.budget is not None:
+            metrics.set("api_quota_budget", limiter.budget)
+        if limiter.db is not None:
+            with limiter.lock:
+                metrics.set("api_quota_used_today", limiter.used_today())
+    if json_path:
+        metrics.write_json(json_path, args=vars(args))
+        print("METRICS written to {}".format(json_path))
+    if prom_path:
+        metrics.write_prometheus(prom_path)
+
+
+def spend_call(city):
+    # Every attempt of an API call, retries too, takes a token of the rate
+    # limit and a call of the quota of city. False once the quota is used
+    if limiter is None:
+        return True
+    if not limiter.take_quota(city):
+        return False
+    limiter.wait()
+    metrics.inc("api_calls_total", city=city or "")
+    return True
+
+
+def get_json(URL, endpoint, city=None):
+    # Returns (data, status code), answers from the response cache when it can
+    # so that only real API calls use up the quota of city
+    if cache is not None:
+        # A --cache_only replay takes recorded responses of any age and must
+        # not expire them
+        raw = cache.get(URL, None if cache_only else CACHE_TTL[endpoint])
+        if raw is not None:
+            metrics.inc("cache_total", endpoint=endpoint, result="hit")
+            with metrics.timer("stage_seconds", stage="decode", endpoint=endpoint):
+                return json.loads(raw), 200
+        metrics.inc("cache_total", endpoint=endpoint, result="miss")
+    if cache_only:
+        return None, NOT_CACHED
+    try:
+        response = http_get(
+            URL,
+            endpoint,
+            headers={"X-Api-Key": API_KEY},
+            before=lambda: spend_call(city),
+        )
+    except requests.RequestException:
+        print("Cannot get response from API")
+        return None, None
+    if response is None:
+        return None, 429
+    if not response.status_code == 200:
+        return None, response.status_code
+    with metrics.timer("stage_seconds", stage="decode", endpoint=endpoint):
+        try:
+            data = response.json()
+        except:
+            print("JSON cannot be loaded")
+            return None, response.status_code
+    if cache is not None:
+        cache.set(URL, response.content, endpoint)
+    return data, response.status_code
+
+
+def report_stages(table, elapsed):
+    # Busy time of a stage is summed over all threads of the stage
+    for stage in ["fetch", "parse", "write"]:
+        hist = metrics.histogram("stage_seconds", stage=stage, table=table)
+        items = hist.count if hist is not None else 0
+        seconds = hist.sum if hist is not None else 0.0
+        rows = metrics.get("rows_total", stage=stage, table=table)
+        print(
+            "{:>6}: {} items, {} rows, busy {:.2f}s, {:.1f} items/s, {:.0f} rows/s".format(
+                stage,
+                items,
+                rows,
+                seconds,
+                items / elapsed if elapsed > 0 else 0,
+                rows / elapsed if elapsed > 0 else 0,
+            )
+        )
+
+
+class PipelineTask:
+    # One work queue of the pipeline: jobs of a city and endpoint, how to
+    # fetch and parse them and the writer for their table. describe(job) is
+    # the progress line printed when the job is written
+    def __init__(self, city, endpoint, jobs, fetch, parse, writer, describe=None):
+        self.city = city
+        self.endpoint = endpoint
+        self.jobs = iter(jobs)
+        self.fetch = fetch
+        self.parse = parse
+        self.writer = writer
+        self.describe = describe
+        self.processed = 0
+        self.stopped = False
+        self.exhausted = False
+
+
+def run_pipeline(tasks, workers, queue_size=None):
+    # fetch(job) -> (data, code) runs on `workers` threads shared by all
+    # tasks, parse(job, data) turns a response into row tuples on one thread
+    # and the rows are written by the writer of the task on this thread, which
+    # also hands out the jobs of the tasks in turn. The queues between the
+    # stages are bounded so a slow stage holds back the ones before it
+    # instead of piling up responses in memory.
+    # A task stops handing out jobs after a 429, jobs already fetched are
+    # still written. Returns the number of jobs processed
+    if queue_size is None:
+        queue_size = 2 * workers
+    job_queue = queue.Queue()
+    raw_queue = queue.Queue(queue_size)
+    row_queue = queue.Queue(queue_size)
+
+    def fetcher():
+        while True:
+            item = job_queue.get()
+            if item is None:
+                raw_queue.put(None)
+                return
+            task, job = item
+            start = time.perf_counter()
+            try:
+                data, code = task.fetch(job)
+            except Exception as e:
+                print("Fetching {} failed: {}".format(job, e))
+                data, code = None, None
+            metrics.observe(
+                "stage_seconds",
+                time.perf_counter() - start,
+                stage="fetch",
+                table=task.writer.table,
+            )
+            raw_queue.put((task, job, data, code))
+
+    def parser():
+        finished = 0
+        while finished < workers:
+            item = raw_queue.get()
+            if item is None:
+                finished = finished + 1
+                continue
+            task, job, data, code = item
+            rows = []
+            if code == 200:
+                start = time.perf_counter()
+                try:
+                    rows = list(task.parse(job, data))
+                except (KeyError, TypeError, AttributeError):
+                    print("Unexpected response for {}".format(job))
+                    code = None
+                metrics.observe(
+                    "stage_seconds",
+                    time.perf_counter() - start,
+                    stage="parse",
+                    table=task.writer.table,
+                )
+                metrics.inc(
+                    "rows_total", len(rows), stage="parse", table=task.writer.table
+                )
+            row_queue.put((task, job, code, rows))
+        row_queue.put(None)
+
+    turn = 0
+
+    def next_job():
+        # Round robin over the tasks that still have jobs
+        nonlocal turn
+        for _ in range(len(tasks)):
+            task = tasks[turn % len(tasks)]
+            turn = turn + 1
+            if task.exhausted or task.stopped:
+                continue
+            job = next(task.jobs, None)
+            if job is not None:
+                return task, job
+            task.exhausted = True
+            if limiter is not None and all(
+                t.exhausted or t.stopped for t in tasks if t.city == task.city
+            ):
+                limiter.finish(task.city)
+        return None
+
+    threads = [threading.Thread(target=fetcher, daemon=True) for _ in range(workers)]
+    threads.append(threading.Thread(target=parser, daemon=True))
+    for thread in threads:
+        thread.start()
+
+    begin = time.perf_counter()
+    exhausted = False
+    purge = False
+    try:
+        while True:
+            if purge:
+                # Claimed jobs of stopped tasks that were not started go back
+                # to the queue with release_claimed_jobs
+                purge = False
+                kept = []
+                while True:
+                    try:
+                        item = job_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None or not item[0].stopped:
+                        kept.append(item)
+                for item in kept:
+                    job_queue.put(item)
+            while not exhausted and job_queue.qsize() < queue_size:
+                item = next_job()
+                if item is None:
+                    exhausted = True
+                    for _ in range(workers):
+                        job_queue.put(None)
+                else:
+                    job_queue.put(item)
+            try:
+                item = row_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            task, job, code, rows = item
+            if code == 429:
+                if not task.stopped:
+                    print("Quota Exceeded for {}".format(task.city))
+                    task.stopped = True
+                    purge = True
+            else:
+                task.processed = task.processed + 1
+            metrics.inc("jobs_total", table=task.writer.table, status=job_status(code))
+            task.writer.add(job[0], code, rows)
+            # Progress is printed here on one thread, fetchers would interleave
+            if task.describe is not None:
+                line = task.describe(job)
+                if code != 200:
+                    line = "{}: {}".format(line, code or "no response")
+                print(line)
+    finally:
+        elapsed = time.perf_counter() - begin
+        for task in tasks:
+            task.writer.flush()
+            print("{} ({}):".format(task.writer.table, task.city))
+            report_stages(task.writer.table, elapsed)
+            task.writer.report()
+    return sum(task.processed for task in tasks)
+
+
+SUBURB_PAGES = {
+    "Sydney": ["https://www.intosydneydirectory.com.au/sydney-postcodes.php"],
+    "Melbourne": [
+        "https://www.homely.com.au/find-suburb-by-region/melbourne-greater-victoria",
+        "http://www.justweb.com.au/post-code/melbourne-postalcodes.html",
+    ],
+}
+# Abbreviations the suburb directories do not agree on
+DIRECTION_WORDS = {"north", "south", "east", "west"}
+NAME_WORDS = {
+    "st": "saint",
+    "mt": "mount",
+    "pt": "point",
+    "nth": "north",
+    "sth": "south",
+}
+
+
+def get_page(URL):
+    # HTML of URL, revalidated with ETag/Last-Modified when we have a copy so
+    # an unchanged page is answered with an empty 304
+    headers = {}
+    body = meta = None
+    if cache is not None:
+        body = cache.get(URL)
+        meta = cache.get("meta:" + URL)
+    if body is not None and meta is not None:
+        meta = json.loads(meta)
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    HTML = http_get(URL, "suburbs", headers=headers)
+    if HTML.status_code == 304 and body is not None:
+        metrics.inc("cache_total", endpoint="suburbs", result="revalidated")
+        return body.decode("utf-8")
+    if not HTML.status_code == 200:
+        sys.exit("{} is not available, RESPONSE {}".format(URL, HTML.status_code))
+    if cache is not None:
+        meta = {
+            "etag": HTML.headers.get("ETag"),
+            "last_modified": HTML.headers.get("Last-Modified"),
+        }
+        cache.set(URL, HTML.content, "suburbs")
+        cache.set("meta:" + URL, json.dumps(meta).encode("utf-8"), "suburbs")
+    return HTML.text
+
+
+def html_section(html, tag, marker=None):
+    # The part of a page from the first to the last <tag> element, or from
+    # the <tag> holding marker, most of a page is navigation and scripts that
+    # need not be parsed
+    lower = html.lower()
+    start = lower.find("<" + tag)
+    if marker is not None and marker in lower:
+        start = lower.rfind("<" + tag, 0, lower.find(marker))
+    end = lower.rfind("</{}>".format(tag))
+    if start < 0 or end < 0:
+        return html
+    return html[start : end + len(tag) + 3]
+
+
+def normalize_name(name):
+    # Lower case words without accents or punctuation, "St. Kilda East" and
+    # "Saint Kilda East" give the same name
+    name = unicodedata.normalize("NFKD", name)
+    name = name.encode("ascii", "ignore").decode("ascii").lower()
+    name = name.replace("&", " and ")
+    words = re.sub(r"[^a-z0-9]+", " ", name.replace("'", "")).split()
+    return " ".join(NAME_WORDS.get(word, word) for word in words)
+
+
+def directions(key):
+    # Brunswick East and Brunswick West are different suburbs a letter or two
+    # apart, only names with the same direction words are close
+    return tuple(sorted(word for word in key.split() if word in DIRECTION_WORDS))
+
+
+def match_postcodes(names, postcodes):
+    # postcodes maps suburb names of another source to their postcode. Exact
+    # normalized names first, then the closest name with the same direction
+    # words for small spelling differences
+    index = {normalize_name(name): code for name, code in postcodes.items()}
+    keys = {}
+    for key in index:
+        keys.setdefault(directions(key), []).append(key)
+    matched = []
+    for name in names:
+        key = normalize_name(name)
+        if key not in index:
+            candidates = keys.get(directions(key), [])
+            close = difflib.get_close_matches(key, candidates, n=1, cutoff=0.9)
+            if not close:
+                print("No postcode data for {}".format(name))
+                continue
+            key = close[0]
+        matched.append((name, index[key]))
+    return matched
 
 
 def get_suburbs(city):
+    if city not in SUBURB_PAGES:
+        sys.exit("No implementation for {}".format(city))
+    start = time.perf_counter()
+    URLS = SUBURB_PAGES[city]
+    with ThreadPoolExecutor(len(URLS)) as pool:
+        pages = list(pool.map(get_page, URLS))
     if city == "Sydney":
-        URL = "https://www.intosydneydirectory.com.au/sydney-postcodes.php"
-        HTML = requests.get(URL)
-        if not HTML.status_code == 200:
-            sys.exit(URL + " is not available\n", "RESPONSE " + HTML.status_code)
-        soup = BeautifulSoup(HTML.text, "html.parser")
+        soup = BeautifulSoup(
+            html_section(pages[0], "table"),
+            "html.parser",
+            parse_only=SoupStrainer("table"),
+        )
         table = soup.find("table")
         rows = table.findAll("tr")
         data = [[cell.text for cell in row("td")] for row in rows]
         del data[0]
-        return data
     elif city == "Melbourne":
-        URL = (
-            "https://www.homely.com.au/find-suburb-by-region/melbourne-greater-victoria"
+        soup = BeautifulSoup(
+            html_section(pages[0], "div", "col-group"),
+            "html.parser",
+            parse_only=SoupStrainer("div", attrs={"class": "col-group"}),
         )
-        HTML = requests.get(URL)
-        if not HTML.status_code == 200:
-            sys.exit(URL + " is not available\n", "RESPONSE " + HTML.status_code)
-        soup = BeautifulSoup(HTML.text, "html.parser")
         allList = soup.find("div", "col-group")
         links = allList.find_all("a")
         Msubs = []
         for link in links:
             Msubs.append(link.get_text())
-        URL = "http://www.justweb.com.au/post-code/melbourne-postalcodes.html"
-        HTML = requests.get(URL)
-        if not HTML.status_code == 200:
-            sys.exit(URL + " is not available\n", "RESPONSE " + HTML.status_code)
-        soup = BeautifulSoup(HTML.text, "html.parser")
+        soup = BeautifulSoup(
+            html_section(pages[1], "select"),
+            "html.parser",
+            parse_only=SoupStrainer("select"),
+        )
         allList = soup.find_all("select")
         subDict = {}
         for entry in allList[1].find_all("option"):
@@ -50,16 +707,13 @@ def get_suburbs(city):
             code = txt[-4:]
             sub = txt[:-4].strip()
             subDict[sub] = code
-        MelSubs = []
-        for sub in Msubs:
-            try:
-                MelSubs.append((sub, subDict[sub]))
-            except:
-                print("No postcode data for {}".format(sub))
-                continue
-        return MelSubs
-    else:
-        sys.exit("No implementation for {}".format(city))
+        data = match_postcodes(Msubs, subDict)
+    print(
+        "SUBURBS {} found for {} in {:.2f}s".format(
+            len(data), city, time.perf_counter() - start
+        )
+    )
+    return data
 
 
 def create_table_suburbs(name):
@@ -88,11 +742,11 @@ def drop_unknown_suburbs(name):
     conn.commit()
 
 
-def create_table_performance(name):
-
-    query = """DROP TABLE IF EXISTS {};""".format(name)
-    sql.execute(query)
-    query = """CREATE TABLE {} (
+def create_table_performance(name, drop=True, latest=True):
+    if drop:
+        query = """DROP TABLE IF EXISTS {};""".format(name)
+        sql.execute(query)
+    query = """CREATE TABLE IF NOT EXISTS {} (
         state TEXT,
         suburb TEXT,
         postcode INTEGER,
@@ -120,183 +774,1083 @@ def create_table_performance(name):
         medianRentListingPrice REAL,
         numberRentListing REAL,
         highestRentListingPrice REAL,
-        lowestRentListingPrice REAL
+        lowestRentListingPrice REAL,
+        PRIMARY KEY ({})
         );""".format(
-        name
+        name, ", ".join(PERFORMANCE_KEY)
     )
 
     sql.execute(query)
+    create_index_performance(name)
+    if latest:
+        create_table_latest(name, drop)
+
 
+def latest_table(name):
+    return name.replace("suburb_performance_", "suburb_latest_", 1)
 
-def create_table_demographic(name):
-    query = """DROP TABLE IF EXISTS {};""".format(name)
+
+def create_table_latest(name, drop=False):
+    # suburb_latest_<city>_<period> holds the row of the latest period of every
+    # suburb, type and bedrooms in the performance table name, for the map.
+    # Triggers keep it up to date as rows are inserted or upserted
+    latest = latest_table(name)
+    if drop:
+        sql.execute("DROP TABLE IF EXISTS {}".format(latest))
+    sql.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = ?", (latest,))
+    exists = sql.fetchone()[0] > 0
+    sql.execute("PRAGMA table_info({})".format(name))
+    columns = [(row[1], row[2]) for row in sql.fetchall()]
+    names = [col for col, _ in columns]
+    query = """CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}));""".format(
+        latest,
+        ", ".join("{} {}".format(col, typ) for col, typ in columns),
+        ", ".join(LATEST_KEY),
+    )
     sql.execute(query)
-    query = """CREATE TABLE {} (
-        suburb TEXT,
-        year INTEGER,
-        category TEXT,
-        subcategory TEXT,
+    if not exists:
+        query = """INSERT OR REPLACE INTO {0} SELECT {1} FROM (SELECT {1},
+            ROW_NUMBER() OVER (PARTITION BY {2} ORDER BY year DESC, month DESC)
+            AS age FROM {3}) WHERE age = 1""".format(
+            latest, ", ".join(names), ", ".join(LATEST_KEY), name
+        )
+        sql.execute(query)
+    update = ", ".join(
+        "{0} = excluded.{0}".format(col) for col in names if col not in LATEST_KEY
+    )
+    for event in ["INSERT", "UPDATE"]:
+        query = """CREATE TRIGGER IF NOT EXISTS {0}_latest_{1} AFTER {1} ON {0}
+            BEGIN
+            INSERT INTO {2} VALUES ({3}) ON CONFLICT ({4}) DO UPDATE SET {5}
+            WHERE excluded.year * 12 + excluded.month >= year * 12 + month;
+            END;""".format(
+            name,
+            event.lower(),
+            latest,
+            ", ".join("NEW." + col for col in names),
+            ", ".join(LATEST_KEY),
+            update,
+        )
+        sql.execute(query)
+
+
+def demographic_fact_table(name):
+    # suburb_demographic_<city> is a view over the integer coded rows in
+    # demographic_facts_<city>
+    return name.replace("suburb_demographic_", "demographic_facts_", 1)
+
+
+def create_table_demographic_lookups():
+    # Names shared by the demographic tables of all cities, the fact tables
+    # only store their ids
+    query = """CREATE TABLE IF NOT EXISTS suburb_names (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+        );"""
+    sql.execute(query)
+    query = """CREATE TABLE IF NOT EXISTS demographic_categories (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+        );"""
+    sql.execute(query)
+    query = """CREATE TABLE IF NOT EXISTS demographic_subcategories (
+        id INTEGER PRIMARY KEY,
+        category_id INTEGER NOT NULL REFERENCES demographic_categories (id),
+        name TEXT NOT NULL,
+        UNIQUE (category_id, name)
+        );"""
+    sql.execute(query)
+    query = """CREATE TABLE IF NOT EXISTS demographic_compositions (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+        );"""
+    sql.execute(query)
+
+
+def create_table_demographic(name, drop=True):
+    # The view keeps the old (suburb, year, category, subcategory, value,
+    # composition) shape for readers, inserts into it go through a trigger
+    # that codes the names and replaces rows with the same key
+    fact = demographic_fact_table(name)
+    if drop:
+        sql.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,))
+        row = sql.fetchone()
+        if row is not None:
+            sql.execute("DROP {} {}".format(row[0].upper(), name))
+        sql.execute("DROP TABLE IF EXISTS {}".format(fact))
+    create_table_demographic_lookups()
+    query = """CREATE TABLE IF NOT EXISTS {} (
+        suburb_id INTEGER NOT NULL,
+        year INTEGER NOT NULL,
+        subcategory_id INTEGER NOT NULL,
+        value REAL,
+        composition_id INTEGER,
+        PRIMARY KEY (suburb_id, year, subcategory_id)
+        ) WITHOUT ROWID;""".format(
+        fact
+    )
+    sql.execute(query)
+    query = """CREATE VIEW IF NOT EXISTS {} AS SELECT s.name AS suburb, f.year AS year,
+        c.name AS category, sc.name AS subcategory, f.value AS value,
+        co.name AS composition
+        FROM {} f
+        JOIN suburb_names s ON s.id = f.suburb_id
+        JOIN demographic_subcategories sc ON sc.id = f.subcategory_id
+        JOIN demographic_categories c ON c.id = sc.category_id
+        LEFT JOIN demographic_compositions co ON co.id = f.composition_id;""".format(
+        name, fact
+    )
+    sql.execute(query)
+    query = """CREATE TRIGGER IF NOT EXISTS {0}_insert INSTEAD OF INSERT ON {0}
+        BEGIN
+        INSERT OR IGNORE INTO suburb_names (name) VALUES (NEW.suburb);
+        INSERT OR IGNORE INTO demographic_categories (name) VALUES (NEW.category);
+        INSERT OR IGNORE INTO demographic_subcategories (category_id, name)
+            SELECT id, COALESCE(NEW.subcategory, '') FROM demographic_categories
+            WHERE name = NEW.category;
+        INSERT OR IGNORE INTO demographic_compositions (name)
+            SELECT NEW.composition WHERE NEW.composition IS NOT NULL;
+        INSERT OR REPLACE INTO {1} VALUES (
+            (SELECT id FROM suburb_names WHERE name = NEW.suburb),
+            NEW.year,
+            (SELECT sc.id FROM demographic_subcategories sc
+                JOIN demographic_categories c ON c.id = sc.category_id
+                WHERE c.name = NEW.category
+                AND sc.name = COALESCE(NEW.subcategory, '')),
+            NEW.value,
+            (SELECT id FROM demographic_compositions WHERE name = NEW.composition));
+        END;""".format(
+        name, fact
+    )
+    sql.execute(query)
+
+
+def demographic_top_table(name):
+    # demographic_top_<city> holds the largest subcategories of every suburb and
+    # category of suburb_demographic_<city> for the pie charts, the view
+    # suburb_demographic_top_<city> gives it names
+    return name.replace("suburb_demographic_", "demographic_top_", 1)
+
+
+def build_demographic_top(name, top=DEMOGRAPHIC_TOP):
+    # Ranks the subcategories of every suburb and category by value and keeps
+    # the first top, each with the remainder after it and the total, so a pie
+    # of any size up to top is a lookup by key. Replaced in one transaction,
+    # readers see either the old or the new ranking
+    table = demographic_top_table(name)
+    fact = demographic_fact_table(name)
+    view = name.replace("suburb_demographic_", "suburb_demographic_top_", 1)
+    query = """CREATE TABLE IF NOT EXISTS {} (
+        suburb_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        subcategory_id INTEGER NOT NULL,
         value REAL,
-        composition TEXT);""".format(
+        rest REAL,
+        total REAL,
+        PRIMARY KEY (suburb_id, category_id, rank)
+        ) WITHOUT ROWID;""".format(
+        table
+    )
+    sql.execute(query)
+    query = """CREATE VIEW IF NOT EXISTS {} AS SELECT s.name AS suburb,
+        c.name AS category, t.rank AS rank, sc.name AS subcategory, t.value AS value,
+        t.rest AS rest, t.total AS total
+        FROM {} t
+        JOIN suburb_names s ON s.id = t.suburb_id
+        JOIN demographic_categories c ON c.id = t.category_id
+        JOIN demographic_subcategories sc ON sc.id = t.subcategory_id;""".format(
+        view, table
+    )
+    sql.execute(query)
+    sql.execute("DELETE FROM {}".format(table))
+    # Census years are added up, as the pie charts did with the raw rows
+    query = """INSERT INTO {} SELECT suburb_id, category_id, rank, subcategory_id,
+        value, total - running, total FROM (SELECT suburb_id, category_id,
+        subcategory_id, value, ROW_NUMBER() OVER ranked AS rank,
+        SUM(value) OVER ranked AS running,
+        SUM(value) OVER (PARTITION BY suburb_id, category_id) AS total
+        FROM (SELECT f.suburb_id, sc.category_id, f.subcategory_id, sc.name,
+            SUM(f.value) AS value
+            FROM {} f JOIN demographic_subcategories sc ON sc.id = f.subcategory_id
+            WHERE f.value IS NOT NULL GROUP BY f.suburb_id, f.subcategory_id)
+        WINDOW ranked AS (PARTITION BY suburb_id, category_id
+            ORDER BY value DESC, name ROWS UNBOUNDED PRECEDING))
+        WHERE rank <= ?""".format(
+        table, fact
+    )
+    sql.execute(query, (top,))
+    rows = sql.rowcount
+    bump_data_version(view)
+    conn.commit()
+    print("RANKED {} rows of {} from {}".format(rows, table, name))
+
+
+def demographic_insert_query(name):
+    # Upserts on a view are not allowed, the trigger replaces existing rows
+    return """INSERT INTO {} VALUES (?,?,?,?,?,?)""".format(name)
+
+
+def create_index_performance(name):
+    # Dashboard filters on suburb/type/bedrooms for the graphs and on a single
+    # period for the map
+    query = """CREATE INDEX IF NOT EXISTS {0}_suburb ON {0} (type, suburb, bedrooms,
+        year, month);""".format(
+        name
+    )
+    sql.execute(query)
+    query = """CREATE INDEX IF NOT EXISTS {0}_period ON {0} (type, bedrooms, year,
+        month);""".format(
         name
     )
     sql.execute(query)
 
 
-def insert_data_suburbs_performance(name, data):
-    query = """INSERT INTO {} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""".format(
+def upsert_query(name, key):
+    # INSERT of a full row that overwrites the stored row with the same key
+    sql.execute("PRAGMA table_info({})".format(name))
+    columns = [row[1] for row in sql.fetchall()]
+    update = ", ".join(
+        "{0} = excluded.{0}".format(col) for col in columns if col not in key
+    )
+    return """INSERT INTO {} VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}""".format(
+        name, ",".join("?" * len(columns)), ", ".join(key), update
+    )
+
+
+def has_primary_key(name):
+    sql.execute("PRAGMA table_info({})".format(name))
+    return any(row[5] > 0 for row in sql.fetchall())
+
+
+def migrate_performance(name):
+    # Rebuilds a performance table from before SCHEMA_VERSION 1 with its
+    # natural key, keeping the last copy of every duplicated row
+    tmp = name + "_migrate"
+    create_table_performance(tmp, latest=False)
+    query = """INSERT OR REPLACE INTO {} SELECT * FROM {} ORDER BY rowid""".format(
+        tmp, name
+    )
+    sql.execute(query)
+    sql.execute("DROP TABLE {}".format(name))
+    sql.execute("ALTER TABLE {} RENAME TO {}".format(tmp, name))
+    # Index names follow the table name
+    sql.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (name,),
+    )
+    for (index,) in sql.fetchall():
+        sql.execute("DROP INDEX {}".format(index))
+    create_index_performance(name)
+    create_table_latest(name, drop=True)
+
+
+def migrate_demographic(name):
+    # Moves a plain demographic table from before SCHEMA_VERSION 2 into the
+    # coded layout, the trigger of the view drops duplicated rows
+    old = name + "_migrate"
+    sql.execute("ALTER TABLE {} RENAME TO {}".format(name, old))
+    create_table_demographic(name)
+    query = """INSERT INTO {} SELECT suburb, year, category, subcategory, value,
+        composition FROM {} ORDER BY rowid""".format(
+        name, old
+    )
+    sql.execute(query)
+    sql.execute("DROP TABLE {}".format(old))
+
+
+def migrate_schema():
+    # Upgrades every data table of an old database to SCHEMA_VERSION
+    query = """SELECT name FROM sqlite_master WHERE type = 'table'
+        AND (name LIKE 'suburb_performance_%' OR name LIKE 'suburb_demographic_%')"""
+    sql.execute(query)
+    migrated = False
+    for (name,) in sql.fetchall():
+        demographic = name.startswith("suburb_demographic_")
+        if not demographic and has_primary_key(name):
+            create_table_latest(name)
+            conn.commit()
+            continue
+        sql.execute("SELECT COUNT(*) FROM {}".format(name))
+        before = sql.fetchone()[0]
+        if demographic:
+            migrate_demographic(name)
+            build_demographic_top(name)
+        else:
+            migrate_performance(name)
+        sql.execute("SELECT COUNT(*) FROM {}".format(name))
+        after = sql.fetchone()[0]
+        bump_data_version(name)
+        conn.commit()
+        print(
+            "MIGRATED {}: {} rows, {} duplicates removed".format(
+                name, after, before - after
+            )
+        )
+        migrated = True
+    sql.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+    conn.commit()
+    if migrated:
+        # Give the pages of the old tables back to the file system
+        sql.execute("VACUUM")
+
+
+def check_schema():
+    sql.execute("PRAGMA user_version")
+    version = sql.fetchone()[0]
+    if version < SCHEMA_VERSION:
+        query = """SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'
+            AND (name LIKE 'suburb_performance_%' OR name LIKE 'suburb_demographic_%')"""
+        sql.execute(query)
+        if sql.fetchone()[0] > 0:
+            sys.exit(
+                "Database schema version {} is older than {}, run with --migrate".format(
+                    version, SCHEMA_VERSION
+                )
+            )
+        sql.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        conn.commit()
+
+
+def create_table_data_version():
+    # Counts the writes to every data table. viz_app.py keys its caches on the
+    # versions, so figures drawn from older data are never served
+    query = """CREATE TABLE IF NOT EXISTS data_version (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at REAL
+        );"""
+    sql.execute(query)
+
+
+def bump_data_version(name):
+    # Part of the transaction of the write, committed by the caller
+    create_table_data_version()
+    query = """INSERT INTO data_version VALUES (?, 1, ?) ON CONFLICT (name)
+        DO UPDATE SET version = version + 1, updated_at = excluded.updated_at"""
+    sql.execute(query, (name, time.time()))
+
+
+def create_table_jobs():
+    # One row per API call we want to make, keeps track of what has been done
+    # so a run can be resumed, failed calls retried and several processes can
+    # share the work
+    query = """CREATE TABLE IF NOT EXISTS ingest_jobs (
+        id INTEGER PRIMARY KEY,
+        city TEXT NOT NULL,
+        suburb TEXT NOT NULL,
+        postcode INTEGER NOT NULL,
+        bedrooms INTEGER NOT NULL DEFAULT 0,
+        type TEXT NOT NULL DEFAULT '',
+        endpoint TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_code INTEGER,
+        claimed_by TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL,
+        priority REAL NOT NULL DEFAULT 0,
+        UNIQUE (city, suburb, postcode, bedrooms, type, endpoint)
+        );"""
+    sql.execute(query)
+    sql.execute("PRAGMA table_info(ingest_jobs)")
+    if "priority" not in [row[1] for row in sql.fetchall()]:
+        query = """ALTER TABLE ingest_jobs ADD COLUMN priority REAL NOT NULL
+            DEFAULT 0"""
+        sql.execute(query)
+    query = """CREATE INDEX IF NOT EXISTS ingest_jobs_status
+        ON ingest_jobs (city, endpoint, status);"""
+    sql.execute(query)
+    # Combinations the API had no data for, survives --reset_table so they are
+    # only asked for again after the re-check interval
+    query = """CREATE TABLE IF NOT EXISTS negative_cache (
+        city TEXT NOT NULL,
+        suburb TEXT NOT NULL,
+        postcode INTEGER NOT NULL,
+        bedrooms INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        endpoint TEXT NOT NULL,
+        last_code INTEGER,
+        misses INTEGER NOT NULL DEFAULT 1,
+        checked_at REAL NOT NULL,
+        PRIMARY KEY (city, suburb, postcode, bedrooms, type, endpoint)
+        );"""
+    sql.execute(query)
+    conn.commit()
+
+
+def reset_jobs(city, endpoint):
+    query = """DELETE FROM ingest_jobs WHERE city = ? AND endpoint = ?"""
+    sql.execute(query, (city, endpoint))
+    conn.commit()
+
+
+def requeue_jobs(city, endpoint):
+    # Starts a new refresh cycle once every job of the last one has finished
+    query = """SELECT COUNT(*) FROM ingest_jobs WHERE city = ? AND endpoint = ?
+        AND status IN ('pending', 'running')"""
+    sql.execute(query, (city, endpoint))
+    if sql.fetchone()[0] > 0:
+        return 0
+    query = """UPDATE ingest_jobs SET status = 'pending', attempts = 0,
+        updated_at = ? WHERE city = ? AND endpoint = ?"""
+    sql.execute(query, (time.time(), city, endpoint))
+    conn.commit()
+    return sql.rowcount
+
+
+def release_stale_jobs(city, endpoint, lease):
+    # Jobs claimed by a process that died are handed out again after the lease
+    query = """UPDATE ingest_jobs SET status = 'pending', claimed_by = NULL,
+        updated_at = ? WHERE city = ? AND endpoint = ? AND status = 'running'
+        AND updated_at < ?"""
+    now = time.time()
+    sql.execute(query, (now, city, endpoint, now - lease))
+    conn.commit()
+    return sql.rowcount
+
+
+def release_claimed_jobs(worker):
+    query = """UPDATE ingest_jobs SET status = 'pending', claimed_by = NULL,
+        updated_at = ? WHERE claimed_by = ? AND status = 'running'"""
+    sql.execute(query, (time.time(), worker))
+    conn.commit()
+
+
+def claim_jobs(city, endpoint, worker, n, retry_failed=False, max_attempts=3):
+    # BEGIN IMMEDIATE takes the write lock, so two processes never claim the
+    # same job
+    if retry_failed:
+        status = "status = 'failed' AND attempts < {}".format(int(max_attempts))
+    else:
+        status = "status = 'pending'"
+    conn.commit()
+    sql.execute("BEGIN IMMEDIATE")
+    try:
+        query = """SELECT id, suburb, postcode, bedrooms, type FROM ingest_jobs
+            WHERE city = ? AND endpoint = ? AND {} ORDER BY priority DESC, id
+            LIMIT ?""".format(
+            status
+        )
+        sql.execute(query, (city, endpoint, n))
+        jobs = sql.fetchall()
+        query = """UPDATE ingest_jobs SET status = 'running', claimed_by = ?,
+            updated_at = ? WHERE id = ?"""
+        now = time.time()
+        sql.executemany(query, [(worker, now, job[0]) for job in jobs])
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return jobs
+
+
+def iter_jobs(city, endpoint, worker, batch, retry_failed=False, max_attempts=3):
+    while True:
+        jobs = claim_jobs(city, endpoint, worker, batch, retry_failed, max_attempts)
+        if not jobs:
+            return
+        for job in jobs:
+            yield job
+
+
+def job_status(code):
+    if code == 200:
+        return "done"
+    elif code == 429 or code == NOT_CACHED:
+        return "pending"
+    return "failed"
+
+
+def is_empty(code, nrows):
+    # The API answered but has nothing for this combination. Other client
+    # errors like 401 and 403 of a bad key, 429, 5xx and network errors are
+    # ordinary failures as they may work next time
+    if code == 200:
+        return nrows == 0
+    return code == 404
+
+
+def finish_jobs(results):
+    # results is a list of (job id, code, number of rows). Does not commit, the
+    # caller commits together with the inserted rows
+    query = """UPDATE ingest_jobs SET status = ?, last_code = ?, claimed_by = NULL,
+        attempts = attempts + ?, updated_at = ? WHERE id = ?"""
+    now = time.time()
+    params = []
+    empty = []
+    found = []
+    for job_id, code, nrows in results:
+        status = job_status(code)
+        if not isinstance(code, int):
+            code = None
+        params.append((status, code, int(status != "pending"), now, job_id))
+        if is_empty(code, nrows):
+            empty.append((code, now, job_id))
+        elif code == 200:
+            found.append((job_id,))
+    sql.executemany(query, params)
+    query = """INSERT INTO negative_cache SELECT city, suburb, postcode, bedrooms,
+        type, endpoint, ?, 1, ? FROM ingest_jobs WHERE id = ?
+        ON CONFLICT (city, suburb, postcode, bedrooms, type, endpoint) DO UPDATE
+        SET last_code = excluded.last_code, misses = misses + 1,
+        checked_at = excluded.checked_at"""
+    sql.executemany(query, empty)
+    query = """DELETE FROM negative_cache WHERE (city, suburb, postcode, bedrooms,
+        type, endpoint) = (SELECT city, suburb, postcode, bedrooms, type, endpoint
+        FROM ingest_jobs WHERE id = ?)"""
+    sql.executemany(query, found)
+
+
+def plan_jobs(city, endpoint, recheck_days, priority_suburbs, latest=None):
+    # Skips combinations known to be empty until their re-check is due and
+    # ranks the rest, suburbs from priority_suburbs first and then the ones
+    # whose stored data is oldest. Returns the number of API calls planned.
+    # Entries of other codes, recorded by older versions, are ignored
+    now = time.time()
+    fresh = """EXISTS (SELECT 1 FROM negative_cache n WHERE n.city = ingest_jobs.city
+        AND n.suburb = ingest_jobs.suburb AND n.postcode = ingest_jobs.postcode
+        AND n.bedrooms = ingest_jobs.bedrooms AND n.type = ingest_jobs.type
+        AND n.endpoint = ingest_jobs.endpoint AND n.last_code IN (200, 404)
+        AND n.checked_at > ?)"""
+    checked = now - recheck_days * 24 * 3600
+    query = """UPDATE ingest_jobs SET status = 'skipped', updated_at = ?
+        WHERE city = ? AND endpoint = ? AND status = 'pending' AND {}""".format(
+        fresh
+    )
+    sql.execute(query, (now, city, endpoint, checked))
+    query = """UPDATE ingest_jobs SET status = 'pending', updated_at = ?
+        WHERE city = ? AND endpoint = ? AND status = 'skipped' AND NOT {}""".format(
+        fresh
+    )
+    sql.execute(query, (now, city, endpoint, checked))
+
+    query = """SELECT id, suburb, postcode, bedrooms, type FROM ingest_jobs
+        WHERE city = ? AND endpoint = ? AND status = 'pending'"""
+    sql.execute(query, (city, endpoint))
+    jobs = sql.fetchall()
+    today = datetime.date.today()
+    current = today.year * 12 + today.month
+    priority = set(priority_suburbs)
+    params = []
+    for job in jobs:
+        # Months since the latest stored period, never fetched counts as 100 years
+        stale = 1200
+        if latest is not None and (job[1], job[2], job[4], job[3]) in latest:
+            stale = current - latest[(job[1], job[2], job[4], job[3])]
+        if job[1] in priority:
+            stale = stale + 10000
+        params.append((stale, job[0]))
+    query = """UPDATE ingest_jobs SET priority = ? WHERE id = ?"""
+    sql.executemany(query, params)
+    conn.commit()
+
+    counts = job_status_counts(city, endpoint)
+    first = sum(1 for job in jobs if job[1] in priority)
+    print(
+        "PLANNED {} calls for {} ({} for priority suburbs), SKIPPED {} known empty".format(
+            len(jobs), endpoint, first, counts.get("skipped", 0)
+        )
+    )
+    if limiter is not None and limiter.daily_quota:
+        print(
+            "Quota of {} calls per day, {} left today, about {} days needed".format(
+                limiter.daily_quota,
+                limiter.budget,
+                -(-len(jobs) // limiter.daily_quota),
+            )
+        )
+    return len(jobs)
+
+
+class BatchWriter:
+    # Buffers rows and job results from many suburbs and writes them in a
+    # single transaction, so a crash never leaves a job marked done without
+    # its rows. Jobs in a lost batch are still 'running' and get re-queued
+    def __init__(self, query, batch_size=5000, max_jobs=500, table=""):
+        self.query = query
+        self.table = table
+        self.batch_size = batch_size
+        self.max_jobs = max_jobs
+        self.rows = []
+        self.jobs = []
+        self.written = 0
+        self.seconds = 0.0
+
+    def add(self, job_id, code, rows):
+        self.rows.extend(rows)
+        self.jobs.append((job_id, code, len(rows)))
+        if len(self.rows) >= self.batch_size or len(self.jobs) >= self.max_jobs:
+            self.flush()
+
+    def flush(self):
+        if not self.jobs:
+            return
+        start = time.perf_counter()
+        sql.executemany(self.query, self.rows)
+        finish_jobs(self.jobs)
+        if self.table and self.rows:
+            bump_data_version(self.table)
+        conn.commit()
+        seconds = time.perf_counter() - start
+        metrics.observe("stage_seconds", seconds, stage="write", table=self.table)
+        metrics.inc("rows_total", len(self.rows), stage="write", table=self.table)
+        self.seconds = self.seconds + seconds
+        self.written = self.written + len(self.rows)
+        print(
+            "DATA INSERTED {} rows for {} jobs".format(len(self.rows), len(self.jobs))
+        )
+        self.rows = []
+        self.jobs = []
+
+    def report(self):
+        rate = self.written / self.seconds if self.seconds > 0 else 0
+        print(
+            "WROTE {} rows in {:.2f}s ({:.0f} rows/s)".format(
+                self.written, self.seconds, rate
+            )
+        )
+
+
+def configure_connection(connection, cache_mb=64):
+    # WAL lets viz_app.py keep reading while we write, synchronous=NORMAL only
+    # syncs at checkpoints which is still crash safe in WAL mode
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA cache_size={}".format(-1024 * cache_mb))
+    connection.execute("PRAGMA temp_store=MEMORY")
+
+
+def job_status_counts(city, endpoint):
+    query = """SELECT status, COUNT(*) FROM ingest_jobs WHERE city = ?
+        AND endpoint = ? GROUP BY status"""
+    sql.execute(query, (city, endpoint))
+    return dict(sql.fetchall())
+
+
+def performance_insert_query(name):
+    return upsert_query(name, PERFORMANCE_KEY)
+
+
+def create_table_derived():
+    # Tables listed here were computed locally, not fetched from the API
+    query = """CREATE TABLE IF NOT EXISTS derived_tables (
+        name TEXT PRIMARY KEY,
+        source TEXT,
+        method TEXT,
+        created_at REAL
+        );"""
+    sql.execute(query)
+
+
+def is_derived(name):
+    create_table_derived()
+    sql.execute("SELECT COUNT(*) FROM derived_tables WHERE name = ?", (name,))
+    return sql.fetchone()[0] > 0
+
+
+def combine(rows, index, rule, weights):
+    # Combines column index of a block of quarterly rows according to ROLLUP
+    values = [row[index] for row in rows if row[index] is not None]
+    if not values:
+        return None
+    how, weight = rule
+    if how == "sum":
+        return sum(values)
+    if how == "max":
+        return max(values)
+    if how == "min":
+        return min(values)
+    pairs = [
+        (row[index], row[weights[weight]] or 0)
+        for row in rows
+        if row[index] is not None
+    ]
+    total = sum(w for _, w in pairs)
+    if total <= 0:
+        return sum(values) / len(values)
+    return sum(v * w for v, w in pairs) / total
+
+
+def rollup_performance(city, period):
+    # Builds the period table of city from the stored quarterly data. Periods
+    # are rolling windows ending at the latest quarter in the table, the same
+    # way the API counts them, and only windows with every quarter are kept.
+    # The windows move with every new quarter, so the table is rebuilt
+    source = "suburb_performance_{}_Quarters".format(city)
+    target = "suburb_performance_{}_{}".format(city, period)
+    quarters = period_months[period] // 3
+    create_table_derived()
+    create_table_performance(target, drop=False)
+    sql.execute("SELECT COUNT(*) FROM {}".format(target))
+    if sql.fetchone()[0] > 0 and not is_derived(target):
+        sys.exit("{} holds API data, use --reset_table to replace it".format(target))
+
+    sql.execute("PRAGMA table_info({})".format(source))
+    columns = [row[1] for row in sql.fetchall()]
+    weights = {col: i for i, col in enumerate(columns)}
+    sql.execute("SELECT MAX(year * 12 + month - 1) FROM {}".format(source))
+    anchor = sql.fetchone()[0]
+    if anchor is None:
+        sys.exit("No quarterly data in {}".format(source))
+
+    # Rows of windows from before the latest quarter would overlap the new
+    # ones, they go in the same transaction as the new rows are written
+    sql.execute("DELETE FROM {}".format(target))
+    sql.execute("DELETE FROM {}".format(latest_table(target)))
+    query = """SELECT * FROM {} ORDER BY state, suburb, postcode, type, bedrooms,
+        year DESC, month DESC""".format(
+        source
+    )
+    cursor = conn.cursor()
+    cursor.execute(query)
+    upsert = performance_insert_query(target)
+    blocks = {}
+    out = []
+    written = 0
+
+    def close_blocks():
+        for (combo, block), rows in blocks.items():
+            if len(rows) < quarters:
+                continue
+            end = anchor - block * quarters * 3
+            row = list(combo) + [end // 12, end % 12 + 1]
+            for i, col in enumerate(columns[len(row) :], len(row)):
+                row.append(combine(rows, i, ROLLUP[col], weights))
+            out.append(row)
+        blocks.clear()
+
+    combo = None
+    for row in cursor:
+        if tuple(row[:5]) != combo:
+            close_blocks()
+            combo = tuple(row[:5])
+        age = anchor - (row[5] * 12 + row[6] - 1)
+        if age % 3:
+            continue
+        blocks.setdefault((combo, age // 3 // quarters), []).append(row)
+        if len(out) >= 10000:
+            sql.executemany(upsert, out)
+            written = written + len(out)
+            out = []
+    close_blocks()
+    sql.executemany(upsert, out)
+    written = written + len(out)
+    query = """INSERT OR REPLACE INTO derived_tables VALUES (?,?,?,?)"""
+    sql.execute(
+        query, (target, source, "rollup of {} quarters".format(quarters), time.time())
+    )
+    bump_data_version(target)
+    conn.commit()
+    print("DERIVED {} rows of {} from {}".format(written, target, source))
+
+
+def latest_periods(name):
+    # Latest stored (year, month) of every combination, as a month count
+    query = """SELECT suburb, postcode, type, bedrooms, MAX(year * 12 + month)
+        FROM {} GROUP BY suburb, postcode, type, bedrooms""".format(
         name
     )
+    sql.execute(query)
+    return {tuple(row[:4]): row[4] for row in sql.fetchall()}
+
+
+def missing_periods(latest, periodSize, totalPeriods, today=None):
+    # Number of periods to ask for so everything after the latest stored period
+    # is covered. The latest stored period is fetched again as it may have been
+    # revised since
+    if latest is None:
+        return totalPeriods
+    if today is None:
+        today = datetime.date.today()
+    elapsed = today.year * 12 + today.month - latest
+    length = period_months[periodSize]
+    missing = -(-elapsed // length) + 1
+    return max(1, min(totalPeriods, missing))
+
+
+def insert_data_suburbs_performance(name, data):
+    query = performance_insert_query(name)
     sql.executemany(query, data)
     print("DATA INSERTED IN TABLE {}".format(name))
 
 
-def get_suburb_performance(
-    state, suburb, postcode, category, bedrooms, periodSize, stPeriod, totalPeriods
+def fetch_suburb_performance(
+    state,
+    suburb,
+    postcode,
+    category,
+    bedrooms,
+    periodSize,
+    stPeriod,
+    totalPeriods,
+    city=None,
 ):
     URL = URL_PERF.format(
         state, suburb, postcode, category, bedrooms, periodSize, stPeriod, totalPeriods
     )
-    try:
-        response = requests.get(URL, headers={"X-Api-Key": API_KEY})
-    except:
-        print("Cannot get response from API")
-        return [], []
-    if not response.status_code == 200:
-        print(response.status_code)
-        return [], response.status_code
-    try:
-        data = response.json()
-    except:
-        print("JSON cannot be loaded")
-        return [], response.status_code
-    outdata = []
+    return get_json(URL, "performance", city)
+
+
+def parse_suburb_performance(data, suburb, postcode, category, bedrooms):
+    state = data["header"]["state"]
     for info in data["series"]["seriesInfo"]:
-        base = [
-            data["header"]["state"],
+        yield (
+            state,
             suburb,
             postcode,
             category,
             bedrooms,
             info["year"],
             info["month"],
-        ]
-        for vals in info["values"].values():
-            base.append(vals)
-        outdata.append(base)
-    return outdata, response.status_code
+        ) + tuple(info["values"].values())
 
 
-def get_suburb_demographic(state, suburb, postcode, year):
+def get_suburb_performance(
+    state, suburb, postcode, category, bedrooms, periodSize, stPeriod, totalPeriods
+):
+    data, code = fetch_suburb_performance(
+        state, suburb, postcode, category, bedrooms, periodSize, stPeriod, totalPeriods
+    )
+    if not code == 200:
+        return [], code
+    return (
+        list(parse_suburb_performance(data, suburb, postcode, category, bedrooms)),
+        code,
+    )
+
+
+def fetch_suburb_demographic(state, suburb, postcode, year, city=None):
     URL = URL_DEM.format(state, suburb, postcode, year)
-    response = requests.get(URL, headers={"X-Api-Key": API_KEY})
-    if not response.status_code == 200:
-        print(response.status_code)
-        return [], response.status_code
+    return get_json(URL, "demographic", city)
 
-    data = response.json()
-    outdata = []
+
+def parse_suburb_demographic(data, suburb, year):
     for entry in data["demographics"]:
         typ = entry["type"]
         for items in entry["items"]:
-            base = [
+            yield (
                 suburb,
                 year,
                 typ,
                 items["label"],
                 items["value"],
                 items["composition"],
-            ]
-            outdata.append(base)
-    return outdata, response.status_code
+            )
 
 
-def insert_suburb_demographic(state, year, query_points, table):
-    idx = 0
-    for point in query_points:
-        print("PROCESSING SUBURB {} ".format(point[0]))
-        data, code = get_suburb_demographic(state, point[0], point[1], year)
-        if not code == 200:
-            if code == 429:
-                print("Quota Exceeded")
-                return idx
-            idx = idx + 1
-            continue
-        query = """INSERT INTO {} VALUES (?,?,?,?,?,?) """.format(table)
-        sql.executemany(query, data)
-        print("DATA INSERTED FOR {}".format(point[0]))
-        conn.commit()
-        idx = idx + 1
-    return idx
+def get_suburb_demographic(state, suburb, postcode, year):
+    data, code = fetch_suburb_demographic(state, suburb, postcode, year)
+    if not code == 200:
+        return [], code
+    return list(parse_suburb_demographic(data, suburb, year)), code
+
 
+def demographic_task(city, year, jobs, table, batch_size):
+    # Pipeline task filling the demographic table of city
+    state = state_map[city]
+    writer = BatchWriter(demographic_insert_query(table), batch_size, table=table)
 
-def insert_suburb_performance_table(
-    city, query_points, table, periodSize, stPeriod, totalPeriods
+    def fetch(job):
+        return fetch_suburb_demographic(state, job[1], job[2], year, city)
+
+    def parse(job, data):
+        return parse_suburb_demographic(data, job[1], year)
+
+    def describe(job):
+        return "PROCESSING SUBURB {} ".format(job[1])
+
+    return PipelineTask(city, "demographic", jobs, fetch, parse, writer, describe)
+
+
+def performance_task(
+    city,
+    jobs,
+    table,
+    periodSize,
+    stPeriod,
+    totalPeriods,
+    batch_size,
+    latest=None,
 ):
+    # Pipeline task filling a performance table of city. With latest from
+    # latest_periods() only periods newer than the stored ones are fetched
     state = state_map[city]
-    idx = 0
-    for query in query_points:
-        print(
-            "PROCESSING SUBURB {} for {} Bedroom {}".format(
-                query[0], query[2], query[3]
-            )
-        )
-        data, code = get_suburb_performance(
+    writer = BatchWriter(performance_insert_query(table), batch_size, table=table)
+
+    def fetch(job):
+        periods = totalPeriods
+        if latest is not None:
+            key = (job[1], job[2], job[4], job[3])
+            periods = missing_periods(latest.get(key), periodSize, totalPeriods)
+        return fetch_suburb_performance(
             state,
-            query[0],
-            query[1],
-            query[3],
-            query[2],
+            job[1],
+            job[2],
+            job[4],
+            job[3],
             periodSize,
             stPeriod,
-            totalPeriods,
+            periods,
+            city,
         )
-        if not code == 200:
-            if code == 429:
-                print("Quota Exceeded")
-                return idx
-            idx = idx + 1
-            continue
-        insert_data_suburbs_performance(table, data)
-        idx = idx + 1
-        conn.commit()
-    return idx
 
+    def parse(job, data):
+        return parse_suburb_performance(data, job[1], job[2], job[4], job[3])
 
-def generate_all_combinations(bedrooms, types, city):
-    # Have to make a list and save to file for all combinations I want
+    def describe(job):
+        return "PROCESSING SUBURB {} for {} Bedroom {}".format(job[1], job[3], job[4])
+
+    return PipelineTask(
+        city, "performance_" + periodSize, jobs, fetch, parse, writer, describe
+    )
+
+
+def generate_all_combinations(bedrooms, types, city, endpoint):
+    # Have to keep a list of all combinations I want
     # Doing this because I am only allowed 500 API calls per day
     # An easy way of keeping track what has been done and what not
+    # Combinations already in the queue are left alone
     query = """SELECT suburb_name, postcode FROM suburbs_{}""".format(city)
     sql.execute(query)
-    query_points = []
     location = sql.fetchall()
     print(bedrooms, types)
+    now = time.time()
+    query_points = []
     for loc in location:
         for beds in bedrooms:
             for ty in types:
-                query_points.append([loc[0], loc[1], beds, ty])
-    return query_points
+                query_points.append(
+                    (city, loc[0], loc[1], beds, ty, endpoint, now, now)
+                )
+    query = """INSERT OR IGNORE INTO ingest_jobs (city, suburb, postcode, bedrooms,
+        type, endpoint, created_at, updated_at) VALUES (?,?,?,?,?,?,?,?)"""
+    sql.executemany(query, query_points)
+    conn.commit()
+    return sql.rowcount
 
 
-def generate_suburbs(city):
-    # Have to make a list and save to file for all combinations I want
+def generate_suburbs(city, endpoint):
+    # Have to keep a list of all suburbs I want
     # Doing this because I am only allowed 500 API calls per day
     # An easy way of keeping track what has been done and what not
     query = """SELECT suburb_name, postcode FROM suburbs_{}""".format(city)
     sql.execute(query)
-    query_points = []
     location = sql.fetchall()
+    now = time.time()
+    query_points = []
     for loc in location:
-        query_points.append([loc[0], loc[1]])
-    return query_points
+        query_points.append((city, loc[0], loc[1], endpoint, now, now))
+    query = """INSERT OR IGNORE INTO ingest_jobs (city, suburb, postcode, endpoint,
+        created_at, updated_at) VALUES (?,?,?,?,?,?)"""
+    sql.executemany(query, query_points)
+    conn.commit()
+    return sql.rowcount
+
+
+def export_parquet(directory, city):
+    # Writes the data tables of city as typed, zstd compressed Parquet datasets
+    # under directory/<dataset>/city=<city>/..., performance data is also
+    # partitioned by type. Rows are sorted so readers can skip row groups
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    types = {
+        "TEXT": pa.dictionary(pa.int32(), pa.string()),
+        "INTEGER": pa.int32(),
+        "REAL": pa.float64(),
+    }
+    query = """SELECT name FROM sqlite_master WHERE type IN ('table', 'view')
+        AND (name LIKE ? OR name LIKE ? OR name IN (?, ?))
+        AND name NOT LIKE '%_migrate'"""
+    sql.execute(
+        query,
+        (
+            "suburb_performance_{}_%".format(city),
+            "suburb_latest_{}_%".format(city),
+            "suburb_demographic_" + city,
+            "suburb_demographic_top_" + city,
+        ),
+    )
+    for (name,) in sql.fetchall():
+        if name.startswith("suburb_performance_"):
+            dataset = "performance_" + name.split("_")[-1]
+            partitions = ["city", "type"]
+            order = "type, suburb, bedrooms, year, month"
+        elif name.startswith("suburb_latest_"):
+            dataset = "latest_" + name.split("_")[-1]
+            partitions = ["city", "type"]
+            order = "type, suburb, bedrooms"
+        elif name.startswith("suburb_demographic_top_"):
+            dataset = "demographic_top"
+            partitions = ["city"]
+            order = "suburb, category, rank"
+        else:
+            dataset = "demographic"
+            partitions = ["city"]
+            order = "suburb, category"
+        sql.execute("PRAGMA table_info({})".format(name))
+        columns = [(row[1], row[2].upper()) for row in sql.fetchall()]
+        # sqlite keeps REAL values in INTEGER columns, e.g. the weighted
+        # daysOnMarket of the rollups, those columns are exported as REAL
+        integers = [col for col, typ in columns if typ == "INTEGER"]
+        if integers:
+            query = "SELECT {} FROM {}".format(
+                ", ".join(
+                    "COALESCE(MAX(typeof({}) = 'real'), 0)".format(col)
+                    for col in integers
+                ),
+                name,
+            )
+            sql.execute(query)
+            fractional = {col for col, real in zip(integers, sql.fetchone()) if real}
+            columns = [
+                (col, "REAL" if col in fractional else typ) for col, typ in columns
+            ]
+        fields = [
+            pa.field(col, pa.string() if col in partitions else types[typ])
+            for col, typ in columns
+        ]
+        schema = pa.schema(fields + [pa.field("city", pa.string())])
+
+        # Built on this thread, sqlite connections can not be shared with the
+        # writer threads of pyarrow
+        batches = []
+        sql.execute("SELECT * FROM {} ORDER BY {}".format(name, order))
+        while True:
+            rows = sql.fetchmany(100000)
+            if not rows:
+                break
+            arrays = []
+            for field, values in zip(schema, zip(*rows)):
+                if pa.types.is_dictionary(field.type):
+                    arrays.append(pa.array(values, pa.string()).dictionary_encode())
+                else:
+                    arrays.append(pa.array(values, field.type))
+            arrays.append(pa.array([city] * len(rows), pa.string()))
+            batches.append(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+        partitioning = ds.partitioning(
+            pa.schema([schema.field(col) for col in partitions]), flavor="hive"
+        )
+        ds.write_dataset(
+            pa.Table.from_batches(batches, schema=schema),
+            os.path.join(directory, dataset),
+            schema=schema,
+            format="parquet",
+            partitioning=partitioning,
+            existing_data_behavior="delete_matching",
+            file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+            max_rows_per_group=64 * 1024,
+        )
+        print("EXPORTED {} to {}".format(name, os.path.join(directory, dataset)))
 
 
 def get_recent_sales(postcode):
     URL = "https://www.corelogic.com.au/our-data/recent-sales?postcode=" + postcode
-    HTML = requests.get(URL)
+    HTML = http_get(URL, "recent_sales")
     if not HTML.status_code == 200:
-        sys.exit(URL + " is not available\n", "RESPONSE " + HTML.status_code)
+        sys.exit("{} is not available, RESPONSE {}".format(URL, HTML.status_code))
     soup = BeautifulSoup(HTML.text, "html.parser")
     print(soup)
     table = soup.find(id="recent-sales")
@@ -311,7 +1865,22 @@ if __name__ == "__main__":
     parser.add_argument(
         "--database_name", type=str, default="test.db", help="Name of sql database"
     )
-    parser.add_argument("--city", type=str, default="Sydney", help="Name of city")
+    parser.add_argument(
+        "--city",
+        type=str,
+        nargs="+",
+        default=["Sydney"],
+        # Only cities with a suburb source, suburbs_<city> is filled from it
+        choices=sorted(SUBURB_PAGES),
+        help="Names of the cities, their work queues are fetched together",
+    )
+    parser.add_argument(
+        "--shares",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Share of the daily quota for each city in --city, equal by default",
+    )
     parser.add_argument(
         "--get_suburbs",
         action="store_true",
@@ -327,6 +1896,39 @@ if __name__ == "__main__":
     )
     parser.add_argument("--fill_table_performance", action="store_true", default=False)
     parser.add_argument("--fill_demographic_table", action="store_true", default=False)
+    parser.add_argument(
+        "--rollup",
+        type=str,
+        nargs="+",
+        default=[],
+        choices=["Years", "HalfYears"],
+        help="Derive these period tables from the stored Quarters table",
+    )
+    parser.add_argument(
+        "--demographic_top",
+        type=int,
+        default=None,
+        help="Rank this many subcategories per suburb and category for the pie "
+        "charts, {} after --fill_demographic_table".format(DEMOGRAPHIC_TOP),
+    )
+    parser.add_argument(
+        "--export_parquet",
+        type=str,
+        default=None,
+        help="Directory to export the tables of the city as Parquet to",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        default=False,
+        help="Upgrade an old database to the current schema, removes duplicate rows",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Only fetch periods newer than the stored ones and update in place",
+    )
     parser.add_argument(
         "--period", type=str, default="Years", help="Years, HalfYears or Quarters"
     )
@@ -337,62 +1939,281 @@ if __name__ == "__main__":
     parser.add_argument(
         "--type", type=str, nargs="+", default=["House"], help="House of Unit"
     )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Number of concurrent API calls"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=2.0, help="Maximum API calls per second"
+    )
+    parser.add_argument(
+        "--daily_quota",
+        type=int,
+        default=500,
+        help="Maximum API calls per day, counted over all runs on the database",
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        default=False,
+        help="Only process jobs that failed with an error other than 429",
+    )
+    parser.add_argument(
+        "--max_attempts", type=int, default=3, help="Give up on a job after this"
+    )
+    parser.add_argument(
+        "--claim_size", type=int, default=100, help="Jobs claimed at once"
+    )
+    parser.add_argument(
+        "--recheck_days",
+        type=float,
+        default=90,
+        help="Days before a combination without data is asked for again",
+    )
+    parser.add_argument(
+        "--priority_suburbs",
+        type=str,
+        nargs="+",
+        default=["Kingsford", "Randwick"],
+        help="Suburbs fetched first, e.g. the ones shown in the dashboard",
+    )
+    parser.add_argument(
+        "--plan_only",
+        action="store_true",
+        default=False,
+        help="Only report the planned API calls, do not fetch anything",
+    )
+    parser.add_argument(
+        "--lease",
+        type=float,
+        default=3600,
+        help="Seconds after which a claimed but unfinished job is handed out again",
+    )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        default="api_cache.db",
+        help="File for cached API responses",
+    )
+    parser.add_argument(
+        "--cache_max_mb", type=int, default=512, help="Size limit of the cache"
+    )
+    parser.add_argument(
+        "--cache_ttl_days",
+        type=float,
+        default=7,
+        help="Days a cached suburb performance response is used for",
+    )
+    parser.add_argument(
+        "--no_cache", action="store_true", default=False, help="Always call the API"
+    )
+    parser.add_argument(
+        "--cache_only",
+        action="store_true",
+        default=False,
+        help="Only replay cached responses, never call the API",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="Retries for connection errors, 5xx and short 429s",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="Read timeout of API calls"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=5000,
+        help="Rows written per transaction",
+    )
+    parser.add_argument(
+        "--cache_mb", type=int, default=64, help="SQLite page cache size"
+    )
+    parser.add_argument(
+        "--metrics_json",
+        type=str,
+        default="ingest_report.json",
+        help="File for the JSON run report, empty to skip",
+    )
+    parser.add_argument(
+        "--metrics_prom",
+        type=str,
+        default="ingest_metrics.prom",
+        help="File for the metrics in Prometheus text format, empty to skip",
+    )
+    parser.add_argument(
+        "--api_base",
+        type=str,
+        default=API_BASE,
+        help="Base URL of the Domain API",
+    )
     args = parser.parse_args()
+    URL_ADD = URL_ADD.replace(API_BASE, args.api_base, 1)
+    URL_PERF = URL_PERF.replace(API_BASE, args.api_base, 1)
+    URL_DEM = URL_DEM.replace(API_BASE, args.api_base, 1)
+    RETRIES = args.retries
+    TIMEOUT = (TIMEOUT[0], args.timeout)
+    cities = list(dict.fromkeys(args.city))
+    shares = args.shares or [1.0] * len(cities)
+    if len(shares) != len(cities):
+        sys.exit("--shares needs one value for each city")
+    session = make_session(args.workers)
+    limiter = RateLimiter(
+        args.rate,
+        daily_quota=args.daily_quota,
+        shares=dict(zip(cities, shares)),
+        database=args.database_name,
+    )
+    if not args.no_cache:
+        cache = DiskCache(args.cache_file, args.cache_max_mb * 1024 * 1024)
+        CACHE_TTL["performance"] = args.cache_ttl_days * 24 * 3600
+    cache_only = args.cache_only
 
-    conn = sqlite3.connect(args.database_name)
+    conn = sqlite3.connect(args.database_name, timeout=60, cached_statements=256)
+    configure_connection(conn, args.cache_mb)
     sql = conn.cursor()
 
+    if args.migrate:
+        migrate_schema()
+    check_schema()
+
     if args.get_suburbs:
-        data = get_suburbs(args.city)
-        create_table_suburbs("suburbs_" + args.city)
-        insert_data_suburbs("suburbs_" + args.city, data)
-        conn.commit()
+        for city in cities:
+            data = get_suburbs(city)
+            create_table_suburbs("suburbs_" + city)
+            insert_data_suburbs("suburbs_" + city, data)
+            conn.commit()
+
+    if args.fill_demographic_table or args.fill_table_performance:
+        # Cities never fetched with --get_suburbs have nothing to queue, the
+        # other cities are still refreshed and get their quota
+        for city in list(cities):
+            sql.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = ?",
+                ("suburbs_" + city,),
+            )
+            if sql.fetchone()[0] == 0:
+                print("No suburbs of {}, skipped. Run --get_suburbs".format(city))
+                cities.remove(city)
+                limiter.finish(city)
 
+    if args.fill_demographic_table or args.fill_table_performance:
+        create_table_jobs()
+        worker = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    # Work queues of all cities and tables, fetched together below
+    tasks = []
     if args.fill_demographic_table:
-        tab_name = "suburb_demographic_" + args.city
-        if args.reset_table:
-            query_points = generate_suburbs(args.city)
-            pkl.dump(query_points, open("query_points_{}.pkl".format(args.city), "wb"))
-            create_table_demographic(tab_name)
-
-        query_points = pkl.load(open("query_points_{}.pkl".format(args.city), "rb"))
-        # 2016 latest census
-        state = state_map[args.city]
-        idx = insert_suburb_demographic(state, "2016", query_points, tab_name)
-        query_points = query_points[idx:]
-        pkl.dump(query_points, open("query_points_{}.pkl".format(args.city), "wb"))
-        print("PROCESSED {} samples, LEFT {} samples".format(idx, len(query_points)))
-
-        query = """SELECT COUNT(*) FROM (select distinct * FROM {})""".format(tab_name)
-        sql.execute(query)
-        print("Table {} has {} entries".format(tab_name, sql.fetchall()))
+        endpoint = "demographic"
+        for city in cities:
+            tab_name = "suburb_demographic_" + city
+            if args.reset_table:
+                create_table_demographic(tab_name)
+                bump_data_version(tab_name)
+                reset_jobs(city, endpoint)
+            create_table_demographic(tab_name, drop=False)
+            generate_suburbs(city, endpoint)
+            release_stale_jobs(city, endpoint, args.lease)
+            plan_jobs(city, endpoint, args.recheck_days, args.priority_suburbs)
+            jobs = iter_jobs(
+                city,
+                endpoint,
+                worker,
+                args.claim_size,
+                args.retry_failed,
+                args.max_attempts,
+            )
+            # 2016 latest census
+            tasks.append(
+                demographic_task(city, "2016", jobs, tab_name, args.batch_size)
+            )
 
     if args.fill_table_performance:
-        tab_name = "suburb_performance_" + args.city + "_" + args.period
-        if args.reset_table:
-            print("Deleting Old Data ... ")
-            query_points = generate_all_combinations(
-                args.bedrooms, args.type, args.city
+        endpoint = "performance_" + args.period
+        for city in cities:
+            tab_name = "suburb_performance_" + city + "_" + args.period
+            if args.reset_table:
+                print("Deleting Old Data ... ")
+                create_table_performance(tab_name)
+                bump_data_version(tab_name)
+                reset_jobs(city, endpoint)
+            create_table_performance(tab_name, drop=False)
+            latest = latest_periods(tab_name)
+            generate_all_combinations(args.bedrooms, args.type, city, endpoint)
+            if args.incremental:
+                requeue_jobs(city, endpoint)
+            release_stale_jobs(city, endpoint, args.lease)
+            plan_jobs(city, endpoint, args.recheck_days, args.priority_suburbs, latest)
+            jobs = iter_jobs(
+                city,
+                endpoint,
+                worker,
+                args.claim_size,
+                args.retry_failed,
+                args.max_attempts,
+            )
+            tasks.append(
+                performance_task(
+                    city,
+                    jobs,
+                    tab_name,
+                    args.period,
+                    1,
+                    args.num_periods,
+                    args.batch_size,
+                    latest if args.incremental else None,
+                )
             )
-            pkl.dump(query_points, open("query_points_{}.pkl".format(args.city), "wb"))
-            create_table_performance(tab_name)
+
+    if tasks and not args.plan_only:
         try:
-            query_points = pkl.load(open("query_points_{}.pkl".format(args.city), "rb"))
-        except:
-            query_points = generate_all_combinations(
-                args.bedrooms, args.type, args.city
+            run_pipeline(tasks, args.workers)
+        finally:
+            release_claimed_jobs(worker)
+        for task in tasks:
+            counts = job_status_counts(task.city, task.endpoint)
+            print(
+                "{}: PROCESSED {} samples, JOBS {}".format(
+                    task.city, task.processed, counts
+                )
             )
+            query = """SELECT COUNT(*) FROM {}""".format(task.writer.table)
+            sql.execute(query)
+            print("Table {} has {} entries".format(task.writer.table, sql.fetchall()))
+
+    for city in cities:
+        for period in args.rollup:
+            if args.reset_table:
+                create_table_performance(
+                    "suburb_performance_{}_{}".format(city, period)
+                )
+            rollup_performance(city, period)
 
-        idx = insert_suburb_performance_table(
-            args.city, query_points, tab_name, args.period, 1, args.num_periods
+        # The ranking follows every demographic fetch, exports get it too
+        tab_name = "suburb_demographic_" + city
+        sql.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name IN (?, ?)",
+            (tab_name, demographic_top_table(tab_name)),
         )
-        query_points = query_points[idx:]
-        pkl.dump(query_points, open("query_points_{}.pkl".format(args.city), "wb"))
-        print("PROCESSED {} samples, LEFT {} samples".format(idx, len(query_points)))
+        found = sql.fetchone()[0]
+        if found and (
+            args.fill_demographic_table
+            or args.demographic_top
+            or (args.export_parquet and found < 2)
+        ):
+            build_demographic_top(tab_name, args.demographic_top or DEMOGRAPHIC_TOP)
 
-        query = """SELECT COUNT(*) FROM (select distinct * FROM {})""".format(tab_name)
-        sql.execute(query)
-        print("Table {} has {} entries".format(tab_name, sql.fetchall()))
+        if args.export_parquet:
+            export_parquet(args.export_parquet, city)
 
     conn.commit()
     conn.close()
+    with limiter.lock:
+        for city in cities:
+            metrics.set("api_quota_allowance", limiter.allowance(city), city=city)
+    print_metrics()
+    write_metrics(args.metrics_json, args.metrics_prom, args)
+    if cache is not None:
+        cache.evict()
+        cache.close()
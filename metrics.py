@@ -0,0 +1,171 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + [float("inf")], self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    # Thread safe counters, gauges and histograms with labels, exported as a
+    # JSON report or in the Prometheus text format
+    def __init__(self, prefix="ingest", buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        # Sum of a counter over all label values that match labels
+        with self.lock:
+            return sum(
+                value
+                for (key, keylabels), value in self.counters.items()
+                if key == name and set(labels.items()) <= set(keylabels)
+            )
+
+    def histogram(self, name, **labels):
+        with self.lock:
+            return self.histograms.get(self.key(name, labels))
+
+    def report(self):
+        def entries(items, convert):
+            return [
+                {"name": name, "labels": dict(labels), "value": convert(value)}
+                for (name, labels), value in sorted(items.items())
+            ]
+
+        with self.lock:
+            return {
+                "started": self.started,
+                "finished": time.time(),
+                "duration": time.time() - self.started,
+                "counters": entries(self.counters, lambda v: v),
+                "gauges": entries(self.gauges, lambda v: v),
+                "histograms": entries(self.histograms, Histogram.summary),
+            }
+
+    def write_json(self, path, **extra):
+        report = self.report()
+        report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+
+    def prometheus(self):
+        def labels(pairs, extra=()):
+            pairs = list(pairs) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, v) for k, v in pairs) + "}"
+
+        def families(items):
+            grouped = {}
+            for (name, pairs), value in sorted(items.items()):
+                grouped.setdefault(name, []).append((pairs, value))
+            return grouped.items()
+
+        lines = []
+        with self.lock:
+            for name, series in families(self.counters):
+                full = "{}_{}".format(self.prefix, name)
+                lines.append("# TYPE {} counter".format(full))
+                for pairs, value in series:
+                    lines.append("{}{} {}".format(full, labels(pairs), value))
+            for name, series in families(self.gauges):
+                full = "{}_{}".format(self.prefix, name)
+                lines.append("# TYPE {} gauge".format(full))
+                for pairs, value in series:
+                    lines.append("{}{} {}".format(full, labels(pairs), value))
+            for name, series in families(self.histograms):
+                full = "{}_{}".format(self.prefix, name)
+                lines.append("# TYPE {} histogram".format(full))
+                for pairs, hist in series:
+                    seen = 0
+                    for bound, n in zip(hist.buckets + ["+Inf"], hist.counts):
+                        seen += n
+                        lines.append(
+                            "{}_bucket{} {}".format(
+                                full, labels(pairs, [("le", bound)]), seen
+                            )
+                        )
+                    lines.append("{}_sum{} {}".format(full, labels(pairs), hist.sum))
+                    lines.append(
+                        "{}_count{} {}".format(full, labels(pairs), hist.count)
+                    )
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as f:
+            f.write(self.prometheus())
@@ -0,0 +1,333 @@
+# Local stand-in for the parts of the Domain API used by house_prices.py, for
+# load tests that should not spend real quota. Run it with
+#
+#   python3 mock_domain_api.py --port 8765 --latency 0.05 --error_rate 0.01
+#
+# and point house_prices.py at it with --api_base http://127.0.0.1:8765
+import argparse
+import datetime
+import json
+import random
+import sqlite3
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+VALUE_NAMES = [
+    "medianSoldPrice",
+    "numberSold",
+    "highestSoldPrice",
+    "lowestSoldPrice",
+    "5thPercentileSoldPrice",
+    "25thPercentileSoldPrice",
+    "75thPercentileSoldPrice",
+    "95thPercentileSoldPrice",
+    "medianSaleListingPrice",
+    "numberSaleListing",
+    "highestSaleListingPrice",
+    "lowestSaleListingPrice",
+    "auctionNumberAuctioned",
+    "auctionNumberSold",
+    "auctionNumberWithdrawn",
+    "daysOnMarket",
+    "discountPercentage",
+    "medianRentListingPrice",
+    "numberRentListing",
+    "highestRentListingPrice",
+    "lowestRentListingPrice",
+]
+PERIOD_MONTHS = {"Years": 12, "HalfYears": 6, "Quarters": 3}
+
+
+class MockConfig:
+    def __init__(
+        self,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        empty_rate=0.0,
+        quota=None,
+        rate=None,
+        retry_after=1,
+        seed=0,
+        replay=None,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.quota = quota
+        self.rate = rate
+        self.retry_after = retry_after
+        self.seed = seed
+        # Recorded responses by path and query, see load_replay
+        self.replay = replay or {}
+        self.used = 0
+        self.window = (0, 0)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+
+def load_replay(path):
+    # Recorded responses from the response cache of house_prices.py
+    conn = sqlite3.connect(path)
+    replay = {}
+    for source, value in conn.execute("SELECT source, value FROM cache"):
+        parts = urlsplit(source)
+        replay[unquote(parts.path + "?" + parts.query)] = zlib.decompress(value)
+    conn.close()
+    return replay
+
+
+def rng(config, *key):
+    # Same request, same payload
+    return random.Random("{}:{}".format(config.seed, ":".join(map(str, key))))
+
+
+def performance_payload(config, state, suburb, postcode, query):
+    category = query.get("propertyCategory", ["House"])[0]
+    bedrooms = int(query.get("bedrooms", ["3"])[0])
+    period = query.get("periodSize", ["Years"])[0]
+    start = int(query.get("startingPeriodRelativeToCurrent", ["1"])[0])
+    total = int(query.get("totalPeriods", ["1"])[0])
+    r = rng(config, suburb, postcode, category, bedrooms, period)
+    series = []
+    if r.random() >= config.empty_rate:
+        today = datetime.date.today()
+        current = today.year * 12 + today.month - 1
+        length = PERIOD_MONTHS.get(period, 12)
+        base = 400000 + 150000 * bedrooms + r.random() * 600000
+        if category == "Unit":
+            base = base * 0.6
+        for i in range(total):
+            end = current - (start - 1 + i) * length
+            p = rng(config, suburb, postcode, category, bedrooms, period, end)
+            price = base * (1 + 0.05 * (end - current) / 12) * (0.9 + 0.2 * p.random())
+            sold = p.randint(0, 60)
+            values = [
+                price,
+                sold,
+                price * 1.8,
+                price * 0.55,
+                price * 0.6,
+                price * 0.85,
+                price * 1.15,
+                price * 1.6,
+                price * 1.03,
+                p.randint(0, 80),
+                price * 1.9,
+                price * 0.5,
+                p.randint(0, 20),
+                p.randint(0, 15),
+                p.randint(0, 3),
+                p.randint(10, 120),
+                p.random() * 8,
+                300 + 120 * bedrooms + p.random() * 200,
+                p.randint(0, 90),
+                900 + 150 * bedrooms,
+                200 + 50 * bedrooms,
+            ]
+            if sold == 0:
+                values[0] = None
+            series.append(
+                {
+                    "year": end // 12,
+                    "month": end % 12 + 1,
+                    "values": dict(zip(VALUE_NAMES, values)),
+                }
+            )
+    return {
+        "header": {
+            "suburb": suburb,
+            "state": state,
+            "propertyCategory": category,
+        },
+        "series": {"seriesInfo": series},
+    }
+
+
+def demographic_payload(config, state, suburb, postcode, query):
+    types = query.get("types", [""])[0].split(",")
+    year = int(query.get("year", ["2016"])[0])
+    demographics = []
+    for typ in dict.fromkeys(t for t in types if t):
+        r = rng(config, suburb, postcode, typ, year)
+        items = [
+            {
+                "label": "{} {}".format(typ, i),
+                "value": float(r.randint(0, 4000)),
+                "composition": None,
+            }
+            for i in range(r.randint(5, 30))
+        ]
+        total = sum(item["value"] for item in items)
+        demographics.append({"type": typ, "total": total, "year": year, "items": items})
+    return {"demographics": demographics}
+
+
+def address_payload(config, query):
+    suburb = query.get("suburb", [""])[0]
+    postcode = query.get("postcode", [""])[0]
+    r = rng(config, suburb, postcode)
+    return [
+        {
+            "ids": [{"level": "Suburb", "id": r.randint(10000, 99999)}],
+            "addressComponents": {
+                "suburb": suburb,
+                "state": query.get("state", [""])[0],
+                "postCode": postcode,
+            },
+        }
+    ]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes, Nagle would hold the body back
+    disable_nagle_algorithm = True
+    config = MockConfig()
+
+    def log_message(self, format, *args):
+        pass
+
+    def count(self, code):
+        with self.config.lock:
+            self.config.counts[code] = self.config.counts.get(code, 0) + 1
+
+    def send(self, code, body=b"", headers=None):
+        self.count(code)
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def quota_headers(self):
+        config = self.config
+        if config.quota is None:
+            return {}
+        return {
+            "X-Quota-PerDay-Limit": config.quota,
+            "X-Quota-PerDay-Remaining": max(0, config.quota - config.used),
+        }
+
+    def admit(self):
+        # Returns the status code to answer with when the call is refused
+        config = self.config
+        with config.lock:
+            if config.quota is not None and config.used >= config.quota:
+                return 429, {}
+            if config.rate is not None:
+                second = int(time.time())
+                start, calls = config.window
+                if start != second:
+                    start, calls = second, 0
+                if calls >= config.rate:
+                    return 429, {"Retry-After": config.retry_after}
+                config.window = (start, calls + 1)
+            config.used = config.used + 1
+        return None, {}
+
+    def do_GET(self):
+        config = self.config
+        if not self.headers.get("X-Api-Key"):
+            self.send(401, b'{"message": "Missing API key"}')
+            return
+        code, headers = self.admit()
+        if code is not None:
+            self.send(code, b'{"message": "Quota exceeded"}', headers)
+            return
+        delay = config.latency + random.uniform(0, config.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < config.error_rate:
+            self.send(500, b'{"message": "Internal error"}', self.quota_headers())
+            return
+
+        parts = urlsplit(self.path)
+        recorded = config.replay.get(unquote(self.path))
+        if recorded is not None:
+            self.send(200, recorded, self.quota_headers())
+            return
+        segments = [unquote(segment) for segment in parts.path.split("/") if segment]
+        query = parse_qs(parts.query)
+        if segments[:2] == ["v1", "addressLocators"]:
+            payload = address_payload(config, query)
+        elif (
+            segments[:2] == ["v2", "suburbPerformanceStatistics"] and len(segments) == 5
+        ):
+            payload = performance_payload(config, *segments[2:], query)
+        elif segments[:2] == ["v2", "demographics"] and len(segments) == 5:
+            payload = demographic_payload(config, *segments[2:], query)
+        else:
+            self.send(404, b'{"message": "Not found"}')
+            return
+        self.send(200, json.dumps(payload).encode("utf-8"), self.quota_headers())
+
+
+def start_server(config, host="127.0.0.1", port=0):
+    # Serves on a background thread, port 0 picks a free port. Returns the
+    # server and its base URL
+    handler = type("Handler", (MockHandler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://{}:{}".format(host, server.server_address[1])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Domain API server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds added to every call"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.0, help="Random extra latency, seconds"
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="Fraction of calls to fail"
+    )
+    parser.add_argument(
+        "--empty_rate",
+        type=float,
+        default=0.0,
+        help="Fraction of combinations without performance data",
+    )
+    parser.add_argument(
+        "--quota", type=int, default=None, help="Calls before answering 429"
+    )
+    parser.add_argument(
+        "--rate", type=int, default=None, help="Calls per second before 429"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default=None,
+        help="Serve recorded responses from a house_prices.py response cache",
+    )
+    args = parser.parse_args()
+
+    config = MockConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        empty_rate=args.empty_rate,
+        quota=args.quota,
+        rate=args.rate,
+        seed=args.seed,
+        replay=load_replay(args.replay) if args.replay else None,
+    )
+    server, url = start_server(config, args.host, args.port)
+    print("Mock Domain API on {}".format(url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,36 @@
+import json
+import time
+
+import house_prices
+from disk_cache import DiskCache
+
+URL = "https://api.domain.com.au/v2/suburbPerformanceStatistics/NSW/Kingsford/2032"
+DATA = {"header": {"state": "NSW"}, "series": {"seriesInfo": []}}
+
+
+def recorded_cache(tmp_path, age):
+    # A cache with the response of URL recorded age seconds ago
+    cache = DiskCache(str(tmp_path / "api_cache.db"))
+    cache.set(URL, json.dumps(DATA).encode("utf-8"), "performance")
+    cache.conn.execute("UPDATE cache SET created_at = ?", (time.time() - age,))
+    cache.conn.commit()
+    return cache
+
+
+def cached_rows(cache):
+    return cache.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+def test_cache_only_replays_responses_older_than_the_ttl(tmp_path, monkeypatch):
+    cache = recorded_cache(tmp_path, 30 * 24 * 3600)
+    monkeypatch.setattr(house_prices, "cache", cache)
+    monkeypatch.setattr(house_prices, "cache_only", True)
+    for _ in range(2):
+        assert house_prices.get_json(URL, "performance") == (DATA, 200)
+    assert cached_rows(cache) == 1
+
+
+def test_expired_responses_are_dropped_outside_cache_only(tmp_path):
+    cache = recorded_cache(tmp_path, 30 * 24 * 3600)
+    assert cache.get(URL, house_prices.CACHE_TTL["performance"]) is None
+    assert cached_rows(cache) == 0
@@ -0,0 +1,54 @@
+import numpy as np
+import pandas as pd
+
+from figures import lttb, performance_figure
+
+
+def padded(series):
+    lengths = np.array([len(ys) for ys in series])
+    xs = np.full((len(series), lengths.max()), np.nan)
+    ys = np.full((len(series), lengths.max()), np.nan)
+    for i, values in enumerate(series):
+        xs[i, : len(values)] = np.arange(len(values))
+        ys[i, : len(values)] = values
+    return xs, ys, lengths
+
+
+def test_lttb_keeps_endpoints_within_threshold():
+    rng = np.random.default_rng(0)
+    xs, ys, lengths = padded([rng.normal(size=100), rng.normal(size=57)])
+    keep = lttb(xs, ys, lengths, 10)
+    assert keep.shape == (2, 10)
+    assert (keep[:, 0] == 0).all()
+    assert (keep[:, -1] == lengths - 1).all()
+    for positions, length in zip(keep, lengths):
+        assert (np.diff(positions) > 0).all()
+        assert positions[-1] < length
+
+
+def test_lttb_keeps_peaks():
+    values = np.zeros(50)
+    values[20] = 100.0
+    values[33] = -100.0
+    xs, ys, lengths = padded([values])
+    keep = lttb(xs, ys, lengths, 6)
+    assert 20 in keep[0] and 33 in keep[0]
+
+
+def test_performance_figure_respects_point_budget():
+    dates = pd.date_range("2000-01-01", periods=200, freq="MS")
+    dff = pd.DataFrame(
+        {
+            "suburb": np.repeat(["Kingsford", "Randwick", "Coogee"], 200),
+            "bedrooms": 3,
+            "DATE": np.tile(dates, 3),
+            "medianSoldPrice": np.arange(600, dtype=np.float64),
+        }
+    )
+    fig = performance_figure(dff, "DATE", ["medianSoldPrice"], point_budget=120)
+    points = [len(trace["x"]) for trace in fig["data"]]
+    assert len(points) == 3
+    assert sum(points) <= 120
+    for trace in fig["data"]:
+        assert trace["x"][0] == "2000-01-01"
+        assert trace["x"][-1] == "2016-08-01"
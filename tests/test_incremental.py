@@ -0,0 +1,58 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import house_prices
+
+TABLE = "suburb_performance_Sydney_Quarters"
+TODAY = datetime.date(2022, 11, 15)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    monkeypatch.setattr(house_prices, "conn", conn, raising=False)
+    monkeypatch.setattr(house_prices, "sql", conn.cursor(), raising=False)
+    house_prices.create_table_performance(TABLE)
+    rows = [
+        ("NSW", "Kingsford", 2032, "House", 3, 2022, 1),
+        ("NSW", "Kingsford", 2032, "House", 3, 2022, 4),
+        ("NSW", "Randwick", 2031, "House", 3, 2021, 7),
+        ("NSW", "Randwick", 2031, "Unit", 2, 2022, 10),
+    ]
+    conn.executemany(
+        """INSERT INTO {} (state, suburb, postcode, type, bedrooms, year, month)
+        VALUES (?,?,?,?,?,?,?)""".format(
+            TABLE
+        ),
+        rows,
+    )
+    return conn
+
+
+def test_latest_periods(database):
+    assert house_prices.latest_periods(TABLE) == {
+        ("Kingsford", 2032, "House", 3): 2022 * 12 + 4,
+        ("Randwick", 2031, "House", 3): 2021 * 12 + 7,
+        ("Randwick", 2031, "Unit", 2): 2022 * 12 + 10,
+    }
+
+
+def test_missing_periods_of_partly_filled_table(database):
+    latest = house_prices.latest_periods(TABLE)
+
+    def periods(key, periodSize="Quarters", totalPeriods=40):
+        return house_prices.missing_periods(
+            latest.get(key), periodSize, totalPeriods, TODAY
+        )
+
+    # 7 months since 2022-04 need 3 new quarters, plus the stored one again
+    assert periods(("Kingsford", 2032, "House", 3)) == 4
+    assert periods(("Randwick", 2031, "House", 3)) == 7
+    assert periods(("Randwick", 2031, "Unit", 2)) == 2
+    assert periods(("Randwick", 2031, "House", 3), "Years") == 3
+    # Capped at the periods a full fetch asks for
+    assert periods(("Randwick", 2031, "House", 3), totalPeriods=5) == 5
+    # Combinations without data get everything
+    assert periods(("Coogee", 2034, "House", 3)) == 40
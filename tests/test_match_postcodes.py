@@ -0,0 +1,27 @@
+from house_prices import match_postcodes
+
+POSTCODES = {
+    "Saint Kilda": "3182",
+    "Mount Waverley": "3149",
+    "Wattleglen": "3096",
+    "Brunswick": "3056",
+    "Brunswick West": "3055",
+}
+
+
+def test_exact_names_after_normalizing():
+    assert match_postcodes(["St Kilda", "Mt Waverley"], POSTCODES) == [
+        ("St Kilda", "3182"),
+        ("Mt Waverley", "3149"),
+    ]
+
+
+def test_close_spelling():
+    assert match_postcodes(["Wattle Glen"], POSTCODES) == [("Wattle Glen", "3096")]
+
+
+def test_direction_words_must_match():
+    assert match_postcodes(["Brunswick East"], POSTCODES) == []
+    assert match_postcodes(["Brunswick Wst", "Brunswick"], POSTCODES) == [
+        ("Brunswick", "3056")
+    ]
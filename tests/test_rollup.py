@@ -0,0 +1,79 @@
+import sqlite3
+
+import pytest
+
+import house_prices
+
+SOURCE = "suburb_performance_Sydney_Quarters"
+TARGET = "suburb_performance_Sydney_HalfYears"
+
+
+@pytest.fixture
+def database(monkeypatch):
+    conn = sqlite3.connect(":memory:")
+    monkeypatch.setattr(house_prices, "conn", conn, raising=False)
+    monkeypatch.setattr(house_prices, "sql", conn.cursor(), raising=False)
+    house_prices.create_table_performance(SOURCE)
+    return conn
+
+
+def add_quarters(conn, rows):
+    conn.executemany(
+        """INSERT INTO {} (state, suburb, postcode, type, bedrooms, year, month,
+        medianSoldPrice, numberSold, highestSoldPrice, lowestSoldPrice)
+        VALUES ('NSW',?,2032,'House',3,?,?,?,?,?,?)""".format(
+            SOURCE
+        ),
+        rows,
+    )
+    conn.commit()
+
+
+def half_years(conn):
+    query = """SELECT suburb, year, month, medianSoldPrice, numberSold,
+        highestSoldPrice, lowestSoldPrice FROM {} ORDER BY suburb, year, month"""
+    return conn.execute(query.format(TARGET)).fetchall()
+
+
+def test_rollup_weights_and_windows(database):
+    add_quarters(
+        database,
+        [
+            ("Kingsford", 2022, 1, 300.0, 0, 310.0, 290.0),
+            ("Kingsford", 2022, 4, 100.0, 0, 110.0, 90.0),
+            ("Kingsford", 2022, 7, 2000.0, 3, 2500.0, 1500.0),
+            ("Kingsford", 2022, 10, 1000.0, 1, 1200.0, 800.0),
+            # The older window of Randwick misses a quarter and is left out
+            ("Randwick", 2022, 4, 500.0, 2, 600.0, 400.0),
+            ("Randwick", 2022, 7, 900.0, 1, 950.0, 850.0),
+            ("Randwick", 2022, 10, None, 2, None, None),
+        ],
+    )
+    house_prices.rollup_performance("Sydney", "HalfYears")
+    # Windows end at the latest quarter, prices are weighted by the number
+    # sold and fall back to the mean where nothing sold
+    assert half_years(database) == [
+        ("Kingsford", 2022, 4, 200.0, 0, 310.0, 90.0),
+        ("Kingsford", 2022, 10, 1750.0, 4, 2500.0, 800.0),
+        ("Randwick", 2022, 10, 900.0, 3, 950.0, 850.0),
+    ]
+
+
+def test_rollup_moves_windows_with_new_quarter(database):
+    add_quarters(
+        database,
+        [
+            ("Kingsford", 2022, 4, 100.0, 1, 100.0, 100.0),
+            ("Kingsford", 2022, 7, 200.0, 1, 200.0, 200.0),
+            ("Kingsford", 2022, 10, 300.0, 1, 300.0, 300.0),
+        ],
+    )
+    house_prices.rollup_performance("Sydney", "HalfYears")
+    assert [row[1:3] for row in half_years(database)] == [(2022, 10)]
+    add_quarters(database, [("Kingsford", 2023, 1, 400.0, 3, 400.0, 400.0)])
+    house_prices.rollup_performance("Sydney", "HalfYears")
+    # The old window overlaps the new ones and is gone
+    assert half_years(database) == [
+        ("Kingsford", 2022, 7, 150.0, 2, 200.0, 100.0),
+        ("Kingsford", 2023, 1, 375.0, 4, 400.0, 300.0),
+    ]
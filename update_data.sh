@@ -1,26 +1,18 @@
 #Script to update data. This is to update suburb performance statistics data
-#We will first look and see if we have started processing before by looking if there is a query_points file available
-#If yes start from there and process, otherwise drop table and start from beginning
-#read -p "Enter City: " city
+#--incremental first finishes the unfinished jobs in the ingest_jobs table if a refresh was interrupted,
+#otherwise it starts a new refresh that only fetches periods newer than what is stored
+#read -p "Enter Cities: " cities
 #read -p "Database name: " db
 #read -p "Bedrooms: " bed
 #read -p "Dwelling type (House/Unit): " dwelling
 #read -p "Period (Years/Half years/Quarters): " period
 #read -p "Number of periods: " nperiod
 
-city=Sydney
+cities='Sydney Melbourne'
 db=housing.db
 bed='3 4'
 dwelling='House Unit'
-period=years
+period=Years
 nperiod=40
 
-#Check if file exists
-if [ -e "query_points_"$city.pkl ]; then
-	echo "query file exists, will update table"
-	python3 house_prices.py --database_name=$db --city=$city --fill_table_performance --period=$period --num_periods=$nperiod --bedroom $bed --type $dwelling
-
-else
-	echo "query file does not exists, will start over"
-	python3 house_prices.py --reset_table --database_name=$db --city=$city --fill_table_performance --period=$period --num_periods=$nperiod --bedroom $bed --type $dwelling
-fi
+python3 house_prices.py --incremental --database_name=$db --city $cities --fill_table_performance --period=$period --num_periods=$nperiod --bedroom $bed --type $dwelling
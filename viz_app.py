@@ -1,6 +1,3 @@
-import sqlite3
-import pandas as pd
-import numpy as np
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
@@ -8,47 +5,134 @@ import plotly.express as px
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash import Patch, ctx
 import plotly.express as px
 import plotly.graph_objects as go
-import pandas as pd
-import sys
+import plotly.io as pio
 import json
+import os
+import argparse
+
+from data_access import open_store
+from disk_cache import DiskCache
+from figures import performance_figure, performance_slice, zoom_range
+
+
+parser = argparse.ArgumentParser(description="Visualise housing data")
+parser.add_argument("city", type=str, help="Name of city")
+parser.add_argument(
+    "--database_name", type=str, default="housing.db", help="Name of sql database"
+)
+parser.add_argument(
+    "--parquet_dir",
+    type=str,
+    default=None,
+    help="Load data exported with house_prices.py --export_parquet instead",
+)
+parser.add_argument(
+    "--period", type=str, default="Years", help="Years, HalfYears or Quarters"
+)
+parser.add_argument(
+    "--geojson",
+    type=str,
+    default=None,
+    help="Suburb boundaries made by geo_prep.py, geo/<city>.geojson by default",
+)
+parser.add_argument(
+    "--cache_size", type=int, default=64, help="Query results kept in memory"
+)
+parser.add_argument(
+    "--figure_cache",
+    type=str,
+    default="figure_cache.db",
+    help="Figures shared by all workers, empty to disable",
+)
+parser.add_argument(
+    "--figure_cache_mb", type=int, default=256, help="Size limit of the figure cache"
+)
+parser.add_argument(
+    "--point_budget",
+    type=int,
+    default=10000,
+    help="Points drawn in the indicator graph before series are downsampled, 0 for all",
+)
+parser.add_argument(
+    "--pie_top",
+    type=int,
+    default=5,
+    help="Subcategories in the pie charts before Other, up to the "
+    "house_prices.py --demographic_top ranking",
+)
+parser.add_argument(
+    "--clientside",
+    action="store_true",
+    default=False,
+    help="Send the rows of a type to the browser once and draw the indicator "
+    "graph there",
+)
+parser.add_argument(
+    "--in_memory",
+    action="store_true",
+    default=False,
+    help="Keep the whole city in memory instead of querying for every figure",
+)
+args = parser.parse_args()
+city = args.city
+# Only the suburb and category names are read at startup, the callbacks query
+# the rows they draw unless --in_memory is set
+store = open_store(
+    city,
+    args.period,
+    args.database_name,
+    args.parquet_dir,
+    args.cache_size,
+    args.in_memory,
+)
+suburbs = store.suburbs()
+cats = store.categories()
+figure_cache = None
+if args.figure_cache:
+    figure_cache = DiskCache(args.figure_cache, args.figure_cache_mb * 1024 * 1024)
+
+
+def cached_figure(name, inputs, build):
+    # Figures are stored as JSON keyed by the normalized inputs and the version
+    # of the data they were drawn from, so an ingest write makes the old ones
+    # unreachable and the LRU eviction of the cache drops them
+    if figure_cache is None:
+        return build()
+    key = json.dumps([name, city, args.period, store.data_version(), inputs])
+    raw = figure_cache.get(key)
+    if raw is not None:
+        return json.loads(raw)
+    fig = build()
+    figure_cache.set(key, pio.to_json(fig, validate=False).encode("utf-8"), "figure")
+    return fig
+
 
-conn = sqlite3.connect("housing.db")
-city = sys.argv[1]
-query = """SELECT * FROM suburb_performance_{}_Years""".format(city)
-df = pd.read_sql_query(query, conn)
-df["DATE"] = pd.to_datetime(df[["year", "month"]].assign(DAY=1))
-query = """SELECT * FROM suburb_demographic_{}""".format(city)
-df_demo = pd.read_sql_query(query, conn)
-suburbs = list(set(df["suburb"].to_list()))
-cats = df_demo["category"].unique()
 external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"]
 types = ["Unit", "House"]
 beds = [1, 2, 3, 4, 5]
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
-filters = ["state", "suburb", "postcode", "type", "bedrooms"]
-available_indicators = df.columns.to_list()
-available_indicators = list(set(available_indicators) - set(filters))
-
-# Get geojson of NSW
-# with open('../nsw.geojson','r') as f:
-#    subs = json.load(f)
-#
-##Get data only for relevant suburbs
-# suburbs_rel = suburbs.copy()
-# subs_geo = {}
-# subs_geo['features']=[]
-# for row in subs['features']:
-#    if(row['properties']['nsw_loca_2'].title() in suburbs_rel):
-#        row['id'] = row['properties']['nsw_loca_2'].title()
-#        subs_geo['features'].append(row)
-#        suburbs_rel.remove(row['id'])
-#    if(len(suburbs_rel)==0):
-#        break
-# subs_geo['type']= 'FeatureCollection'
+available_indicators = store.indicators
+
+# Simplified suburb boundaries from geo_prep.py, loaded once and sent to the
+# browser with the first map only
+geo_path = args.geojson or os.path.join("geo", city + ".geojson")
+subs_geo = None
+geo_version = None
+map_center = {"lat": -33.8893, "lon": 151.092}
+if os.path.exists(geo_path):
+    with open(geo_path) as f:
+        subs_geo = json.load(f)
+    geo_version = os.path.getmtime(geo_path)
+    if os.path.exists(geo_path + ".meta.json"):
+        with open(geo_path + ".meta.json") as f:
+            map_center = json.load(f)["center"]
+else:
+    print("No suburb boundaries in {}, run geo_prep.py".format(geo_path))
 
 app.layout = html.Div(
     [
@@ -154,7 +238,7 @@ app.layout = html.Div(
         html.Div([html.H2("Map")]),
         html.Div(
             [
-                html.P("Data based on 2021"),
+                html.P("Latest period of each suburb"),
                 html.Div(
                     [
                         dcc.Dropdown(
@@ -201,62 +285,94 @@ app.layout = html.Div(
 )
 
 
-@app.callback(
-    Output("indicator-graphic", "figure"),
-    Input("filt", "value"),
-    Input("filt2", "value"),
-    Input("filt3", "value"),
-    Input("xaxis-column", "value"),
-    Input("yaxis-column", "value"),
-)
-def update_graph(filt, filt2, filt3, xaxis_column_name, yaxis_column_name):
-    dff = df.loc[df["suburb"].isin(filt)]
-    dff = dff.loc[dff["bedrooms"].isin(filt3)]
-    dff = dff[dff["type"] == filt2]
-    sList = filt.copy()
-    fig = px.line(
-        dff,
-        x=xaxis_column_name,
-        y=yaxis_column_name[0],
-        color="bedrooms",
-        line_dash="suburb",
-        labels={"bedrooms": "Beds", "suburb": "Suburb"},
+def update_graph(
+    filt, filt2, filt3, xaxis_column_name, yaxis_column_name, relayout_data
+):
+    # The rows come sorted from the store, the order suburbs and bedrooms were
+    # picked in does not change the figure. A zoom into the dates redraws the
+    # visible range within the point budget, at full resolution once few
+    # enough points are left
+    filt = sorted(set(filt or []))
+    filt3 = sorted(set(filt3 or []))
+    x_range = zoom_range(relayout_data) if xaxis_column_name == "DATE" else None
+    inputs = [filt, filt2, filt3, xaxis_column_name, yaxis_column_name]
+    return cached_figure(
+        "graph",
+        inputs + [x_range, args.point_budget],
+        lambda: graph_figure(*inputs, x_range),
     )
-    sList = yaxis_column_name.copy()
-    del sList[0]
-    for var in sList:
-        fig2 = px.line(
-            dff, x=xaxis_column_name, y=var, color="bedrooms", line_dash="suburb"
-        ).update_traces(mode="lines+markers")
-        for i in range(len(fig2.data)):
-            fig.add_trace(fig2.data[i])
-
-    fig.update_layout(margin={"l": 40, "b": 40, "t": 10, "r": 0}, hovermode="closest")
-    fig.update_layout(legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
 
-    return fig
+
+def graph_figure(filt, filt2, filt3, xaxis_column_name, yaxis_column_name, x_range):
+    dff = store.performance(filt, filt2, filt3, [xaxis_column_name] + yaxis_column_name)
+    return performance_figure(
+        dff, xaxis_column_name, yaxis_column_name, args.point_budget, x_range
+    )
+
+
+def update_price_data(request):
+    # Rows of every suburb and bedrooms of a type for the clientside graph,
+    # asked for again only when the type changes or an indicator is missing
+    typ = request["type"]
+    columns = [col for col in request["columns"] if col in available_indicators]
+    return cached_figure(
+        "slice",
+        [typ, columns],
+        lambda: performance_slice(
+            store.performance(suburbs, typ, beds, columns), typ, columns
+        ),
+    )
+
+
+if args.clientside:
+    # Suburb, bedrooms and indicator changes are drawn in the browser by
+    # assets/price_explorer.js
+    app.layout.children.append(dcc.Store(id="price-request"))
+    app.layout.children.append(dcc.Store(id="price-data"))
+    app.clientside_callback(
+        ClientsideFunction("price_explorer", "request"),
+        Output("price-request", "data"),
+        Input("filt2", "value"),
+        Input("xaxis-column", "value"),
+        Input("yaxis-column", "value"),
+        State("price-data", "data"),
+    )
+    app.callback(Output("price-data", "data"), Input("price-request", "data"))(
+        update_price_data
+    )
+    app.clientside_callback(
+        ClientsideFunction("price_explorer", "figure"),
+        Output("indicator-graphic", "figure"),
+        Input("price-data", "data"),
+        Input("filt", "value"),
+        Input("filt3", "value"),
+        Input("xaxis-column", "value"),
+        Input("yaxis-column", "value"),
+    )
+else:
+    app.callback(
+        Output("indicator-graphic", "figure"),
+        Input("filt", "value"),
+        Input("filt2", "value"),
+        Input("filt3", "value"),
+        Input("xaxis-column", "value"),
+        Input("yaxis-column", "value"),
+        Input("indicator-graphic", "relayoutData"),
+    )(update_graph)
 
 
 @app.callback(
     Output("pie-chart", "figure"), Input("subs", "value"), Input("var", "value")
 )
-def dummy_pie_chart(*args, **kwargs):
-    return generate_pie_chart(*args, **kwargs)
+def dummy_pie_chart(subs, var):
+    return cached_figure(
+        "pie", [subs, var, args.pie_top], lambda: generate_pie_chart(subs, var)
+    )
 
 
 def generate_pie_chart(subs, var):
-    dff = df_demo[df_demo["suburb"] == subs]
-    dff = dff[dff["category"] == var]
-    total = dff["value"].sum()
-    dff = dff.nlargest(5, "value")
-    other = total - dff["value"].sum()
-    if other > 0:
-        dff.reset_index(inplace=True, drop=True)
-        dff.loc[dff.shape[0]] = dff.loc[dff.shape[0] - 1]
-        dff.loc[
-            dff.shape[0] - 1, "subcategory"
-        ] = "Other"  # To display correct proportions in pie chart
-        dff.loc[dff.shape[0] - 1, "value"] = other
+    # Ranked when the data was written, the store looks the slices up by key
+    dff = store.demographic_top(subs, var, args.pie_top)
     fig = px.pie(dff, values="value", names="subcategory", labels={"subcategory": var})
     fig.update_traces(textinfo="percent+label", textposition="inside")
     fig.update_layout(
@@ -275,8 +391,10 @@ def generate_pie_chart(subs, var):
 @app.callback(
     Output("pie-chart2", "figure"), Input("subs1", "value"), Input("var1", "value")
 )
-def dummy_pie_chart2(*args, **kwargs):
-    return generate_pie_chart(*args, **kwargs)
+def dummy_pie_chart2(subs, var):
+    return cached_figure(
+        "pie", [subs, var, args.pie_top], lambda: generate_pie_chart(subs, var)
+    )
 
 
 @app.callback(
@@ -286,31 +404,50 @@ def dummy_pie_chart2(*args, **kwargs):
     Input("ind3", "value"),
 )
 def get_map_plot(ind, ind2, ind3):
-    # get latest data for each suburb
-    # df_map = df.sort_values('DATE').groupby('suburb').tail(1)
-    # print(df_map.medianSoldPrice.info())
-    df_map = df[
-        (df["year"] == 2022)
-        & (df["month"] == 4)
-        & (df["bedrooms"] == ind3)
-        & (df["type"] == ind2)
-    ]
-    df_map = df_map[(df_map["bedrooms"] == ind3) & (df_map["type"] == ind2)]
-    df_map = df_map[~df_map[ind].isna()]
-    fig = px.choropleth_mapbox(
-        df_map,
-        geojson=subs_geo,
-        locations="suburb",
-        color=ind,
-        color_continuous_scale="Viridis",
-        # range_color=(0, 1e5),
+    # Only the first figure carries the boundaries, later changes patch the
+    # values
+    if subs_geo is not None and ctx.triggered_id is not None:
+        locations, values, hover = map_values(ind, ind2, ind3)
+        fig = Patch()
+        fig["data"][0]["locations"] = locations
+        fig["data"][0]["z"] = values
+        fig["data"][0]["hovertemplate"] = hover
+        fig["data"][0]["colorbar"]["title"]["text"] = ind
+        return fig
+    return cached_figure(
+        "map", [ind, ind2, ind3, geo_version], lambda: map_figure(ind, ind2, ind3)
+    )
+
+
+def map_values(ind, ind2, ind3):
+    # Latest data for each suburb, kept up to date by house_prices.py
+    df_map = store.latest(ind2, ind3, ind)
+    locations = df_map["suburb"].astype(str).to_list()
+    values = df_map[ind].to_list()
+    hover = "%{location}<br>" + ind + " %{z}<extra></extra>"
+    return locations, values, hover
+
+
+def map_figure(ind, ind2, ind3):
+    locations, values, hover = map_values(ind, ind2, ind3)
+    fig = go.Figure(
+        go.Choroplethmapbox(
+            geojson=subs_geo or {"type": "FeatureCollection", "features": []},
+            locations=locations,
+            z=values,
+            colorscale="Viridis",
+            marker_opacity=0.3,
+            marker_line_width=0.5,
+            hovertemplate=hover,
+            colorbar={"title": {"text": ind}},
+        )
+    )
+    fig.update_layout(
         mapbox_style="carto-positron",
-        zoom=10,
-        center={"lat": -33.8893, "lon": 151.092},
-        opacity=0.3,
-        # labels={'unemp':'unemployment rate'}
+        mapbox_zoom=10,
+        mapbox_center=map_center,
+        margin={"r": 0, "t": 0, "l": 0, "b": 0},
     )
-    fig.update_layout(margin={"r": 0, "t": 0, "l": 0, "b": 0})
     return fig
 
 